@@ -25,15 +25,124 @@ Code for creating AEM inversion and data objects
 '''
 import pickle
 import h5py
+import netCDF4
 import numpy as np
 import spatial_functions
-from netcdf_utils import get_lines, testNetCDFDataset, get_lookup_mask
-from misc_utils import check_list_arg, dict_to_hdf5, extract_hdf5_data
+from netcdf_utils import get_lines, testNetCDFDataset, get_lookup_mask, get_line_index, read_points, get_point_chunk_size
+from misc_utils import check_list_arg, dict_to_hdf5, extract_hdf5_data, dict_to_section_store, extract_section_store_data, LazySection
 import misc_utils
 import gc, glob, os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from shapely.geometry import LineString
 import re
 
+def get_line_variables(dataset, variables):
+    """Get the variables to extract for each line. If the dataset has the
+    derived line_distance variable it is added so the along-line distances
+    are not recalculated.
+
+    Parameters
+    ----------
+    dataset : object
+        netcdf dataset
+    variables : list
+        List of variables to be gridded.
+
+    Returns
+    -------
+    list
+        List of variables to extract from the dataset.
+
+    """
+    if np.logical_and('line_distance' in dataset.variables,
+                      'line_distance' not in variables):
+        return variables + ['line_distance']
+    return variables
+
+def get_distance_array(var_dict, section_variables):
+    """Get the along-line distances for a line, using the precomputed
+    line_distance variable if it has been extracted.
+
+    Parameters
+    ----------
+    var_dict : dictionary
+        dictionary of sorted line variables.
+    section_variables : list
+        List of variables to be gridded.
+
+    Returns
+    -------
+    array
+        Array of along-line distances
+
+    """
+    if 'line_distance' in var_dict:
+        distances = np.ma.getdata(var_dict['line_distance'])
+        # Remove if it was only extracted to avoid recalculating distances
+        if 'line_distance' not in section_variables:
+            del var_dict['line_distance']
+        return distances
+
+    utm_coordinates = np.column_stack((var_dict['easting'],
+                                       var_dict['northing']))
+    return spatial_functions.coords2distance(utm_coordinates)
+
+# AEM inversion instances opened by gridding worker processes. These are kept
+# so each worker only opens the netcdf file once
+_worker_inversions = {}
+
+def _grid_line_worker(nc_path, name, inversion_type, section_variables, line,
+                      gridding_params, hdf5_fname = None, return_interpolated = False):
+    """Grid a single line within a worker process. The netcdf file is opened
+    read-only by the worker itself.
+
+    Parameters
+    ----------
+    nc_path : string
+        Path to the netcdf file with the AEM inversion.
+    name : string
+        Name of the AEM inversion.
+    inversion_type : string
+        One of 'deterministic' or 'stochastic'
+    section_variables : list
+        List of variables to grid.
+    line : integer
+        AEM line number.
+    gridding_params : dictionary
+        parameters for interpolation.
+    hdf5_fname : string
+        If not None the gridded variables are saved to this hdf5 file.
+    return_interpolated : boolean
+        If True the gridded variables are returned to the parent process.
+
+    Returns
+    -------
+    dictionary
+        Dictionary of interpolated variables or None
+
+    """
+    key = (nc_path, name, inversion_type)
+    if key not in _worker_inversions:
+        _worker_inversions[key] = AEM_inversion(name = name,
+                                                inversion_type = inversion_type,
+                                                netcdf_dataset = netCDF4.Dataset(nc_path, 'r'))
+    inversion = _worker_inversions[key]
+    inversion.section_variables = section_variables
+
+    line_no, cond_var_dict = next(get_lines(inversion.data,
+                                            line_numbers=[line],
+                                            variables=get_line_variables(inversion.data,
+                                                                         section_variables)))
+
+    interpolated = inversion.grid_line(line_no, cond_var_dict, gridding_params)
+
+    if hdf5_fname is not None:
+        dict_to_hdf5(hdf5_fname, interpolated)
+
+    if return_interpolated:
+        return interpolated
+    return None
+
 class AEM_inversion:
     """
     Class for handling AEM inversions
@@ -69,6 +178,8 @@ class AEM_inversion:
             # Create an instance variable of the coordinates
             self.coords = np.column_stack((netcdf_dataset['easting'][:],
                                            netcdf_dataset['northing'][:])).data
+            # Spatial index for the coordinates. The KD-tree is built on first use
+            self.spatial_index = spatial_functions.SpatialIndex(self.coords)
             # Get some of the usefule metadata from the netcdf file
             self.xmin = np.min(netcdf_dataset['easting'][:])
             self.xmax = np.max(netcdf_dataset['easting'][:])
@@ -78,8 +189,27 @@ class AEM_inversion:
         else:
             self.data = None
 
+    def load_spatial_index(self, infile):
+        """Load a previously saved spatial index for the coordinates.
+
+        Parameters
+        ----------
+        infile : string
+            path to pickle file saved using spatial_index.save
+        Returns
+        -------
+        self, object
+            SpatialIndex instance
+
+        """
+        spatial_index = spatial_functions.SpatialIndex.load(infile)
+        assert np.array_equal(spatial_index.coords, self.coords)
+        self.spatial_index = spatial_index
+
     def grid_sections(self, variables, lines, xres, yres, resampling_method = 'cubic',
-                      return_interpolated = False, save_hdf5 = True, hdf5_dir = None):
+                      return_interpolated = False, save_hdf5 = True, hdf5_dir = None,
+                      n_workers = 1, executor = None, section_store = None,
+                      store_kwargs = None):
         """A function for gridding AEM inversoin variables into sections.
            This method can handle both 1D and 2D variables
 
@@ -104,6 +234,18 @@ class AEM_inversion:
             If True, we will save the gridded variables as a hdf5 file.
         hdf5_dir : string
             Path to directory in which the hdf5 files are to be saved.
+        n_workers : integer
+            Number of processes for gridding lines. If greater than 1 the lines
+            are spread across a process pool. Lines that fail are listed in
+            the gridding_failures attribute rather than aborting the run.
+        executor : concurrent.futures.Executor
+            Optional executor to use instead of creating a process pool.
+        section_store : string
+            If not None, the gridded variables are saved to this single hdf5
+            section store rather than one hdf5 file per line in hdf5_dir.
+        store_kwargs : dictionary
+            Keyword arguments for misc_utils.dict_to_section_store, e.g.
+            {'compression': 'gzip', 'dtype': np.float32}
 
 
         Returns
@@ -117,6 +259,8 @@ class AEM_inversion:
         lines = check_list_arg(lines)
         variables = check_list_arg(variables)
 
+        store_kwargs = store_kwargs or {}
+
 
         # Add key variables if they aren't in the list to grid
         for item in ['easting', 'northing', 'elevation', 'fiducial', 'layer_top_depth', 'layer_centre_depth']:
@@ -129,7 +273,8 @@ class AEM_inversion:
 
         cond_lines= get_lines(self.data,
                               line_numbers=lines,
-                              variables=self.section_variables)
+                              variables=get_line_variables(self.data,
+                                                           self.section_variables))
 
         # Interpolated results will be added to a dictionary
         interpolated = {}
@@ -139,27 +284,28 @@ class AEM_inversion:
         gridding_params = {'xres': xres, 'yres': yres,
                            'resampling_method': resampling_method}
 
+        # Spread the lines across a pool of processes
+        if n_workers > 1 or executor is not None:
+            self.grid_sections_parallel(lines, gridding_params, return_interpolated,
+                                        save_hdf5, hdf5_dir, n_workers, executor,
+                                        section_store, store_kwargs)
+            return
+
         # Iterate through the lines
         for i in range(len(lines)):
 
             # Extract the variables and coordinates for the line in question
             line_no, cond_var_dict = next(cond_lines)
 
-
-            # Now we need to sort the cond_var_dict and run it east to west
-            cond_var_dict = spatial_functions.sort_variables(cond_var_dict)
-
-            # If there is no 'layer_top_depth' add it
-            if np.logical_and('layer_top_depth' not in cond_var_dict,
-                              'layer_centre_depth' in cond_var_dict):
-
-                cond_var_dict['layer_top_depth'] = spatial_functions.layer_centre_to_top(cond_var_dict['layer_centre_depth'])
-
-            interpolated[line_no] =  self.grid_variables(line_no, cond_var_dict,  gridding_params)
+            interpolated[line_no] =  self.grid_line(line_no, cond_var_dict,  gridding_params)
             # Save to hdf5 file if the keyword is passed
             if save_hdf5:
-                fname = os.path.join(hdf5_dir, str(int(line_no)) + '.hdf5')
-                dict_to_hdf5(fname, interpolated[line_no])
+                if section_store is not None:
+                    dict_to_section_store(section_store, line_no, interpolated[line_no],
+                                          **store_kwargs)
+                else:
+                    fname = os.path.join(hdf5_dir, str(int(line_no)) + '.hdf5')
+                    dict_to_hdf5(fname, interpolated[line_no])
 
             # Many lines may fill up memory so if the dictionary is not being returned then
             # we garbage collect
@@ -175,6 +321,126 @@ class AEM_inversion:
         else:
             self.section_data = None
 
+    def grid_sections_parallel(self, lines, gridding_params, return_interpolated = False,
+                               save_hdf5 = True, hdf5_dir = None, n_workers = 2,
+                               executor = None, section_store = None, store_kwargs = None):
+        """Grid lines in parallel using a pool of processes. Each worker opens
+        the netcdf file read-only and writes its own hdf5 file for each line.
+
+        Parameters
+        ----------
+        lines : list of integers
+            List of AEM line numbers to grid.
+        gridding_params : dictionary
+            parameters for interpolation.
+        return_interpolated : boolean
+            If True there will be a class variables for the gridded variables
+             for each line
+        save_hdf5 : boolean
+            If True, we will save the gridded variables as a hdf5 file.
+        hdf5_dir : string
+            Path to directory in which the hdf5 files are to be saved.
+        n_workers : integer
+            Number of processes in the pool.
+        executor : concurrent.futures.Executor
+            Optional executor to use instead of creating a process pool.
+        section_store : string
+            If not None, the gridded variables are saved to this hdf5 section
+            store. Workers return their sections and the store is written by
+            this process as hdf5 files cannot be written concurrently.
+        store_kwargs : dictionary
+            Keyword arguments for misc_utils.dict_to_section_store
+
+        Returns
+        -------
+        self, dictionary
+            gridding_failures dictionary with the error message for each line
+            that failed to grid
+
+        """
+        store_kwargs = store_kwargs or {}
+
+        if executor is None:
+            with ProcessPoolExecutor(max_workers = n_workers) as pool:
+                return self.grid_sections_parallel(lines, gridding_params,
+                                                   return_interpolated, save_hdf5,
+                                                   hdf5_dir, executor = pool,
+                                                   section_store = section_store,
+                                                   store_kwargs = store_kwargs)
+
+        nc_path = self.data.filepath()
+
+        save_store = save_hdf5 and section_store is not None
+
+        futures = {}
+        for line in lines:
+            if save_hdf5 and not save_store:
+                fname = os.path.join(hdf5_dir, str(int(line)) + '.hdf5')
+            else:
+                fname = None
+            future = executor.submit(_grid_line_worker, nc_path, self.name,
+                                     self.inversion_type, self.section_variables,
+                                     line, gridding_params, fname,
+                                     return_interpolated or save_store)
+            futures[future] = line
+
+        interpolated = {}
+        failures = {}
+
+        for i, future in enumerate(as_completed(futures)):
+            line = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failures[line] = repr(e)
+                print("Line {} failed: {}".format(line, repr(e)))
+            else:
+                if save_store:
+                    dict_to_section_store(section_store, line, result, **store_kwargs)
+                if return_interpolated:
+                    interpolated[line] = result
+            print("Gridded {} of {} lines".format(i + 1, len(futures)))
+
+        if len(failures) > 0:
+            print("Failed to grid lines: {}".format(', '.join([str(l) for l in failures])))
+
+        self.gridding_failures = failures
+
+        # Return the lines in the order they were requested
+        if return_interpolated:
+            self.section_data = {line: interpolated[line] for line in lines
+                                 if line in interpolated}
+        else:
+            self.section_data = None
+
+    def grid_line(self, line_no, cond_var_dict, gridding_params):
+        """Sort the variables for a single line and grid them.
+
+        Parameters
+        ----------
+        line_no : int
+            line number.
+        cond_var_dict : dictionary
+            dictionary of variables to be gridded.
+        gridding_params : dictionary
+            parameters for interpolation.
+
+        Returns
+        -------
+        dictionary
+            Dictionary of inteprolated variables
+        """
+        # Now we need to sort the cond_var_dict and run it east to west
+        cond_var_dict = spatial_functions.sort_variables(cond_var_dict)
+
+        # If there is no 'layer_top_depth' add it
+        if np.logical_and('layer_top_depth' not in cond_var_dict,
+                          'layer_centre_depth' in cond_var_dict):
+
+            cond_var_dict['layer_top_depth'] = spatial_functions.layer_centre_to_top(cond_var_dict['layer_centre_depth'])
+
+        return self.grid_variables(line_no, cond_var_dict, gridding_params)
+
     def grid_variables(self, line, cond_var_dict, gridding_params):
         """Function controlling the vertical gridding of 2D and 1D variables.
 
@@ -198,10 +464,6 @@ class AEM_inversion:
 
         # Create a sort mask in cases where the lines are not in order
 
-        # Define coordinates
-        utm_coordinates = np.column_stack((cond_var_dict['easting'],
-                                          cond_var_dict['northing']))
-
         # Add the flag to the dictionary
         #if utm_coordinates[0, 0] > utm_coordinates[-1, 0]:
         #    cond_var_dict['reverse_line'] = True
@@ -209,7 +471,8 @@ class AEM_inversion:
         #    cond_var_dict['reverse_line'] = False
 
         # Add distance array to dictionary
-        cond_var_dict['distances'] = spatial_functions.coords2distance(utm_coordinates)
+        cond_var_dict['distances'] = get_distance_array(cond_var_dict,
+                                                       self.section_variables)
 
 
         # Add number of epth cells to the array
@@ -303,29 +566,70 @@ class AEM_inversion:
         self.layer_grids = layer_grids
 
 
-    def load_sections_from_file(self, hdf5_dir, grid_vars, lines = []):
+    def load_sections_from_file(self, hdf5_dir, grid_vars, lines = None,
+                                lazy = False, window = None):
         """Load pre-gridded AEM sections from file.
 
         Parameters
         ----------
         hdf5_dir : string
-            Path to hdf5 files.
+            Path to hdf5 files or to a hdf5 section store.
 
         grid_vars : list
             A list of variables to load from hdf5 files
 
+        lines : list
+            A list of lines to load. If None or empty all lines are loaded.
+
+        lazy : boolean
+            If True each line is a misc_utils.LazySection and variables are
+            only read from file when they are accessed.
+
+        window : tuple
+            If not None a (minimum, maximum) tuple of grid distances. Only the
+            part of each section within this window is read.
+
         Returns
         -------
         self, dictionary
             Python dictionary with gridded line data
 
         """
+        if lines is not None and len(lines) == 0:
+            lines = None
+
+        section_store = os.path.isfile(hdf5_dir)
+
+        # All lines are within a single section store
+        if section_store and not lazy and window is None:
+            self.section_data = extract_section_store_data(hdf5_dir, grid_vars, lines)
+            return
+
         interpolated = {}
         # iterate through the files
-        if lines == []:
-            for file in glob.glob(os.path.join(hdf5_dir, '*.hdf5')):
-                line = int(os.path.basename(file).split('.')[0])
-                lines.append(line)
+        if lines is None:
+            lines = []
+            if section_store:
+                with h5py.File(hdf5_dir, 'r') as f:
+                    lines = sorted([int(x) for x in f.keys()])
+            else:
+                for file in glob.glob(os.path.join(hdf5_dir, '*.hdf5')):
+                    line = int(os.path.basename(file).split('.')[0])
+                    lines.append(line)
+
+        if lazy or window is not None:
+            for line in lines:
+                if section_store:
+                    section = LazySection(hdf5_dir, grid_vars, group_name = str(int(line)),
+                                          window = window)
+                else:
+                    section = LazySection(os.path.join(hdf5_dir, str(line) + '.hdf5'),
+                                          grid_vars, window = window)
+                # Read the windowed arrays now unless lazy loading
+                interpolated[line] = section if lazy else dict(section)
+
+            self.section_data = interpolated
+            return
 
         for line in lines:
 
@@ -352,17 +656,103 @@ class AEM_inversion:
                               "line_index" in self.data.variables)
         self.flight_lines = {}
 
-        for i, line in enumerate(self.data['line'][:]):
-            mask = np.where(self.data['line_index'][:] == i)
+        line_index = get_line_index(self.data)
+        # Read the variables once rather than once per line
+        fiducial = self.data['fiducial'][:]
+        easting_all = self.data['easting'][:]
+        northing_all = self.data['northing'][:]
+
+        for line in self.data['line'][:]:
+            mask = line_index.point_indices(line)
             # First sort by fiducial
-            sort_mask = np.argsort(self.data['fiducial'][mask])
+            sort_mask = np.argsort(fiducial[mask])
             # now get the easting and northing and sort
-            easting = self.data['easting'][mask][sort_mask]
-            northing = self.data['northing'][mask][sort_mask]
+            easting = easting_all[mask][sort_mask]
+            northing = northing_all[mask][sort_mask]
 
             # add the polyline to the attribute
             self.flight_lines[line] = LineString(np.column_stack((easting, northing)))
 
+class NoiseModel:
+    """
+    Noise for AEM gate data that combines an additive noise for each gate with
+    a multiplicative noise. The noise is computed from the netCDF data variable
+    when it is indexed, so the full noise array is never held in memory unless
+    it is asked for.
+    """
+    def __init__(self, data_variable, additive_noise, multiplicative_noise = 0.03):
+        """Initialise the noise model.
+
+        Parameters
+        ----------
+        data_variable : object
+            netCDF4 variable with the EM data with dimensions (point, gate)
+        additive_noise : array
+            Additive noise for each gate
+        multiplicative_noise : float
+            Fraction of the EM data used as the multiplicative noise
+
+        """
+        self.data_variable = data_variable
+        self.additive_noise = np.asarray(additive_noise)
+        self.multiplicative_noise = multiplicative_noise
+
+    @property
+    def shape(self):
+        return self.data_variable.shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return np.result_type(self.data_variable.dtype, self.additive_noise.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        aem_gate_data = np.ma.getdata(self.data_variable[index])
+
+        # Find the gates selected by the index so the additive noise broadcasts
+        if isinstance(index, tuple) and len(index) > 1:
+            additive_noise = self.additive_noise[index[1]]
+        else:
+            additive_noise = self.additive_noise
+
+        # Get sum of squares of two noise sources
+        return np.sqrt((self.multiplicative_noise * aem_gate_data)**2 + additive_noise**2)
+
+    def __array__(self, dtype = None, copy = None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def to_netcdf(self, dataset, variable_name, chunk_size = None):
+        """Write the noise to a netCDF variable a chunk of points at a time.
+
+        Parameters
+        ----------
+        dataset : object
+            netCDF4 dataset opened in append mode
+        variable_name : string
+            Name of the noise variable. It is created with the dimensions of
+            the data variable if it does not exist
+        chunk_size : integer
+            Target number of points to compute at a time
+
+        """
+        if variable_name not in dataset.variables:
+            dataset.createVariable(variable_name, self.dtype, self.data_variable.dimensions)
+        variable = dataset.variables[variable_name]
+
+        npoints = self.shape[0]
+        chunk_size = get_point_chunk_size(dataset, [variable_name], chunk_size)
+
+        for start in range(0, npoints, chunk_size):
+            chunk = slice(start, min(start + chunk_size, npoints))
+            variable[chunk] = self[chunk]
+
 class AEM_data:
     """
     Class for handling AEM inversions
@@ -395,6 +785,8 @@ class AEM_data:
             # Create an instance variable of the coordinates
             self.coords = np.column_stack((netcdf_dataset['easting'][:],
                                            netcdf_dataset['northing'][:])).data
+            # Spatial index for the coordinates. The KD-tree is built on first use
+            self.spatial_index = spatial_functions.SpatialIndex(self.coords)
             # Get some of the usefule metadata from the netcdf file
             self.xmin = np.min(netcdf_dataset['easting'][:])
             self.xmax = np.max(netcdf_dataset['easting'][:])
@@ -404,6 +796,23 @@ class AEM_data:
         else:
             self.data = None
 
+    def load_spatial_index(self, infile):
+        """Load a previously saved spatial index for the coordinates.
+
+        Parameters
+        ----------
+        infile : string
+            path to pickle file saved using spatial_index.save
+        Returns
+        -------
+        self, object
+            SpatialIndex instance
+
+        """
+        spatial_index = spatial_functions.SpatialIndex.load(infile)
+        assert np.array_equal(spatial_index.coords, self.coords)
+        self.spatial_index = spatial_index
+
     def calculate_additive_noise(self, aem_gate_data, high_altitude_mask):
         """Function for calculating the additive noise from high altitude lines.
 
@@ -423,8 +832,9 @@ class AEM_data:
         high_alt_data = aem_gate_data[high_altitude_mask,:]
         arr = np.sqrt(np.std(high_alt_data, axis = 0)**2)
 
-        # Now repeat to size of gate dat array
-        return np.repeat(arr[np.newaxis,:], aem_gate_data.shape[0], axis=0)
+        # Now broadcast to size of gate dat array. This is a read only view
+        # that stores the noise once per gate
+        return np.broadcast_to(arr[np.newaxis,:], aem_gate_data.shape)
 
     def calculate_noise(self, data_variable, noise_variable = None, additive_noise_variable = None,
                         multiplicative_noise = 0.03, high_altitude_lines = None):
@@ -447,8 +857,9 @@ class AEM_data:
 
         Returns
         -------
-        self, array
-            An array of EM noise estimates
+        self, NoiseModel
+            EM noise estimates. These are computed from the data when indexed
+            and can be written to the netCDF file with NoiseModel.to_netcdf
 
         """
         if noise_variable is None:
@@ -461,21 +872,20 @@ class AEM_data:
 
         high_altitude_mask = get_lookup_mask(high_altitude_lines, self.data)
 
-        # Get the AEM data
-        aem_gate_data = self.data[data_variable][:].data
-
+        # Get the AEM data for the high altitude lines only
+        high_alt_data = np.ma.getdata(read_points(self.data[data_variable],
+                                                  np.where(high_altitude_mask)[0]))
 
         # Calculate the additive noies
-        additive_noise_arr = self.calculate_additive_noise(aem_gate_data, high_altitude_mask)
+        additive_noise_arr = self.calculate_additive_noise(high_alt_data,
+                                                           np.ones(high_alt_data.shape[0], dtype = bool))
 
         # Set the additive noise as an attribute
         setattr(self, additive_noise_variable, (additive_noise_arr[0]))
 
-        # Calculate multiplicative noise
-        mulitplicative_noise_arr = multiplicative_noise * aem_gate_data
-
-        # Get sum of squares of two noise sources
-        noise =  np.sqrt(mulitplicative_noise_arr**2 + additive_noise_arr**2)
+        # The total noise is calculated from the data lazily
+        noise = NoiseModel(self.data[data_variable], additive_noise_arr[0],
+                           multiplicative_noise = multiplicative_noise)
 
         setattr(self, noise_variable, noise)
 
@@ -492,7 +902,8 @@ class AEM_data:
 
 
         # Add distance array to dictionary
-        em_var_dict['distances'] = spatial_functions.coords2distance(em_var_dict['utm_coordinates'])
+        em_var_dict['distances'] = get_distance_array(em_var_dict,
+                                                     self.section_variables)
 
         vars_2d = [v for v in self.section_variables if em_var_dict[v].ndim == 2]
         vars_1d = [v for v in self.section_variables if em_var_dict[v].ndim == 1]
@@ -515,7 +926,10 @@ class AEM_data:
         interpolated_utm = np.column_stack((interpolated['easting'],
                                             interpolated['northing']))
 
-        interp2d = spatial_functions.interpolate_data(vars_2d, em_var_dict, interpolated_utm)
+        # The interpolated coordinates are at the grid distances so we pass these
+        # rather than projecting the coordinates back onto the line
+        interp2d = spatial_functions.interpolate_data(vars_2d, em_var_dict, interpolated_utm,
+                                                      interpolated_distances = em_var_dict['grid_distances'])
 
         for var in vars_2d:
             # Generator yields the interpolated variable array
@@ -541,7 +955,8 @@ class AEM_data:
 
         em_lines = get_lines(self.data,
                               line_numbers=lines,
-                              variables=self.section_variables)
+                              variables=get_line_variables(self.data,
+                                                           self.section_variables))
 
         # Interpolated results will be added to a dictionary
         interpolated = {}
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+#===============================================================================
+#    Copyright 2017 Geoscience Australia
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#===============================================================================
+'''
+Functions for reading the definitions of ASEG-GDF2 .dfn files
+'''
+
+import re
+
+# Format specification of a field e.g. 'F8.2' or '30E15.6'
+FORMAT_SPEC = re.compile(r"^(\d*)([AIFED])(\d+)(?:\.(\d+))?$", re.IGNORECASE)
+
+def parse_dfn(dfn_file):
+    """Parse the field definitions of an ASEG-GDF2 .dfn file.
+
+    Parameters
+    ----------
+    dfn_file : string
+        Path to the .dfn file
+
+    Returns
+    -------
+    list
+        List of field dictionaries, in column order, with the keys
+        'name', 'count' (number of elements), 'type' (one of A, I, F, E, D),
+        'width' (of each element), 'decimals', 'format' (e.g. '30E15.6'),
+        'line' (line number in the .dfn), 'start' (column of the first
+        character in a row) and 'attributes' (e.g. UNITS, NULL and NAME)
+
+    """
+    fields = []
+    start = 0
+    with open(dfn_file, 'r') as f:
+        for i, line in enumerate(f):
+            # Skip comment records and lines that are not definitions
+            if not line.startswith('DEFN') or ';' not in line or 'RT=COMM' in line:
+                continue
+            body = line.split(';', 1)[1]
+            if body.strip().upper().startswith('END DEFN'):
+                break
+            parts = body.split(':', 2)
+            if len(parts) < 2:
+                continue
+            fmt = parts[1].strip()
+            match = FORMAT_SPEC.match(fmt)
+            if match is None:
+                raise ValueError("Unable to parse format {} on line {} of {}".format(fmt, i + 1, dfn_file))
+            count, ftype, width, decimals = match.groups()
+            # The remaining text has comma separated KEY=VALUE attributes
+            attributes = {}
+            if len(parts) == 3:
+                for item in parts[2].split(','):
+                    if '=' in item:
+                        key, value = item.split('=', 1)
+                        attributes[key.strip().upper()] = value.strip()
+            field = {'name': parts[0].strip(),
+                     'count': int(count) if count else 1,
+                     'type': ftype.upper(),
+                     'width': int(width),
+                     'decimals': int(decimals) if decimals else 0,
+                     'format': fmt,
+                     'line': i,
+                     'start': start,
+                     'attributes': attributes}
+            start += field['count'] * field['width']
+            fields.append(field)
+    return fields
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+
+#===============================================================================
+#    Copyright 2017 Geoscience Australia
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#===============================================================================
+
+"""
+A script for converting an ASEG-GDF2 .dat/.dfn pair into a netcdf point
+dataset with the layout used by AEM_inversion and AEM_data.
+
+The .dfn file is parsed once and the fixed-width .dat file is read in chunks
+of rows. Each chunk is read as a block of bytes and the columns are converted
+to numbers with numpy, so the rows are never split into python strings.
+
+Every field becomes a variable with the point dimension. Array fields get a
+second dimension, which is 'layer' for fields with the same number of
+elements as the conductivity field. The line field is written as a 'line'
+variable of the unique line numbers with a 'line_index' variable for each
+point. The geospatial extent of the points is added as global attributes.
+
+The .dat file must have fixed-width rows. Files with overflowing columns can
+be fixed using historic/fix_rjmcmctdem_file.py.
+
+usage: aseg_gdf2netcdf.py infile.dat outfile.nc [--dfn DFN] [--crs EPSG]
+                          [--dimension FIELD=DIMENSION] [-c CHUNK_SIZE]
+"""
+
+import netCDF4
+import os
+import sys
+import numpy as np
+import datetime
+import argparse
+from pyproj import CRS,Transformer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from aseg_gdf2_utils import parse_dfn
+
+# Target size of the chunks along the point dimension in bytes
+CHUNK_BYTES = 4 * 1024**2
+
+def field_dtype(field):
+    """Get the numpy data type used to store a field."""
+    if field['type'] == 'A':
+        return np.dtype(str)
+    if field['type'] == 'I':
+        return np.dtype(np.int32) if field['width'] < 10 else np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+def _null_value(field):
+    # Null value from the .dfn attributes. Integer fields without one use the
+    # netcdf default fill value so that blank values can be stored
+    if field['type'] == 'A':
+        return None
+    dtype = field_dtype(field)
+    null = field['attributes'].get('NULL')
+    if null is not None:
+        try:
+            return dtype.type(float(null))
+        except ValueError:
+            pass
+    if dtype.kind == 'i':
+        return dtype.type(netCDF4.default_fillvals[dtype.str[1:]])
+    return None
+
+def parse_column(block, field):
+    """Convert the bytes of a field to values.
+
+    Parameters
+    ----------
+    block : array
+        uint8 array with shape (nrows, row length) of the rows in a chunk
+    field : dictionary
+        Field from parse_dfn
+
+    Returns
+    -------
+    array
+        Array with shape (nrows,) for single fields or (nrows, count) for
+        array fields
+
+    """
+    nrows = block.shape[0]
+    width, count = field['width'], field['count']
+    column = block[:, field['start']:field['start'] + width * count].copy()
+
+    if field['type'] in 'ED':
+        # numpy only reads 'E' exponents
+        column[(column == ord('D')) | (column == ord('d'))] = ord('E')
+
+    strings = column.view('S{}'.format(width)).reshape(nrows, count)
+
+    if field['type'] == 'A':
+        values = np.char.strip(strings.astype(str))
+    else:
+        # Blank values are read as the null value, or nan if there isn't one
+        blank = (column.reshape(nrows, count, width) == ord(' ')).all(axis = 2)
+        if blank.any():
+            strings = strings.copy()
+            strings[blank] = b'0'
+        values = strings.astype(field_dtype(field))
+        if blank.any():
+            null = _null_value(field)
+            values[blank] = null if null is not None else np.nan
+
+    return values[:, 0] if count == 1 else values
+
+def _row_length(dat_file):
+    # Length of the first row, including its line ending, and the line ending
+    with open(dat_file, 'rb') as f:
+        row = f.readline()
+    ending = row[len(row.rstrip(b'\r\n')):]
+    if len(row) > 0 and len(ending) == 0:
+        # A single row without a line ending
+        return len(row) + 1, b'\n'
+    return len(row), ending
+
+def read_chunks(dat_file, fields, chunk_size = 100000):
+    """Generator that yields the values of each field for chunks of rows.
+
+    Parameters
+    ----------
+    dat_file : string
+        Path to the .dat file
+    fields : list
+        Fields from parse_dfn
+    chunk_size : integer
+        Number of rows in each chunk
+
+    Yields
+    ------
+    dictionary
+        Dictionary of arrays for each field keyed by field name
+
+    """
+    # The length of the first row, including the line ending, must be the
+    # length of every row
+    row_length, ending = _row_length(dat_file)
+    if row_length == 0:
+        return
+    row_width = fields[-1]['start'] + fields[-1]['count'] * fields[-1]['width']
+    # Rows can only be longer than the .dfn row width by trailing blanks
+    padding = row_length - len(ending) - row_width
+    if padding < 0:
+        raise ValueError("Rows of {} are shorter than the .dfn row width of {}. "
+                         "Use fix_rjmcmctdem_file.py to fix it".format(dat_file, row_width))
+
+    with open(dat_file, 'rb') as f:
+        while True:
+            buffer = f.read(chunk_size * row_length)
+            if len(buffer) == 0:
+                break
+            # The last row may not have a line ending
+            if len(buffer) % row_length == row_length - len(ending):
+                buffer += ending
+            if len(buffer) % row_length != 0:
+                raise ValueError("{} does not have fixed width rows. "
+                                 "Use fix_rjmcmctdem_file.py to fix it".format(dat_file))
+            block = np.frombuffer(buffer, dtype = np.uint8).reshape(-1, row_length)
+            if not np.all(block[:, -1] == ord('\n')):
+                raise ValueError("{} does not have fixed width rows. "
+                                 "Use fix_rjmcmctdem_file.py to fix it".format(dat_file))
+            if padding > 0 and not np.all(block[:, row_width:row_width + padding] == ord(' ')):
+                raise ValueError("Rows of {} are longer than the .dfn row width of {}, e.g. "
+                                 "due to overflowing values. Use fix_rjmcmctdem_file.py to "
+                                 "fix it".format(dat_file, row_width))
+            yield {field['name']: parse_column(block, field) for field in fields}
+
+def get_dimensions(fields, dimensions = None):
+    """Get the dimension name for the elements of each array field.
+
+    Parameters
+    ----------
+    fields : list
+        Fields from parse_dfn
+    dimensions : dictionary
+        Dimension names keyed by field name. Array fields that are not
+        included use 'layer' if they have the same number of elements as the
+        conductivity field, otherwise '<field name>_element'
+
+    Returns
+    -------
+    dictionary
+        Dictionary with the dimension name and size for each array field
+
+    """
+    dimensions = dimensions or {}
+
+    counts = {field['name']: field['count'] for field in fields}
+    nlayers = counts.get('conductivity')
+
+    field_dims = {}
+    for field in fields:
+        if field['count'] == 1:
+            continue
+        if field['name'] in dimensions:
+            name = dimensions[field['name']]
+        elif field['count'] == nlayers:
+            name = 'layer'
+        else:
+            name = '{}_element'.format(field['name'])
+        field_dims[field['name']] = (name, field['count'])
+
+    # Make sure each dimension has a single size
+    sizes = {}
+    for name, size in field_dims.values():
+        if sizes.setdefault(name, size) != size:
+            raise ValueError("Dimension {} is used for fields with different sizes".format(name))
+
+    return field_dims
+
+def aseg_gdf2netcdf(dat_file, nc_outfile, dfn_file = None, chunk_size = 100000,
+                    dimensions = None, crs = None, crs_geographic = 7844,
+                    x_field = 'easting', y_field = 'northing',
+                    elevation_field = 'elevation', complevel = 4, date_created = None):
+    """Convert an ASEG-GDF2 .dat file into a netcdf point dataset.
+
+    Parameters
+    ----------
+    dat_file : string
+        Path to the .dat file
+    nc_outfile : string
+        Path to the output netcdf file
+    dfn_file : string
+        Path to the .dfn file. Defaults to the .dat file with a .dfn extension
+    chunk_size : integer
+        Number of rows read and written at a time
+    dimensions : dictionary
+        Dimension names for the elements of array fields keyed by field name.
+        See get_dimensions
+    crs : integer
+        EPSG code of the projected coordinates. If given, longitude and
+        latitude variables are added
+    crs_geographic : integer
+        EPSG code of the longitudes and latitudes
+    x_field, y_field, elevation_field : string
+        Names of the coordinate fields in the .dfn file
+    complevel : integer
+        zlib compression level
+    date_created : string
+        Value of the date_created attribute. Defaults to the current UTC time
+
+    """
+    if dfn_file is None:
+        dfn_file = os.path.splitext(dat_file)[0] + '.dfn'
+
+    fields = parse_dfn(dfn_file)
+
+    # The record type field is not data
+    fields_out = [field for field in fields if field['name'].upper() != 'RT']
+
+    field_dims = get_dimensions(fields_out, dimensions)
+
+    # The rows have fixed length so we know the number of points. The last
+    # row may not have a line ending
+    row_length, ending = _row_length(dat_file)
+    npoints = (os.path.getsize(dat_file) + len(ending)) // row_length if row_length > 0 else 0
+
+    has_lines = any(field['name'] == 'line' for field in fields_out)
+
+    if crs is not None:
+        crs_projected = CRS.from_epsg(crs)
+        crs_geographic = CRS.from_epsg(crs_geographic)
+        transformer = Transformer.from_crs(crs_projected, crs_geographic, always_xy=True)
+
+    rootgrp = netCDF4.Dataset(nc_outfile, "w", format="NETCDF4")
+
+    rootgrp.createDimension("point", npoints)
+    for name, size in sorted(set(field_dims.values())):
+        rootgrp.createDimension(name, size)
+
+    def create_variable(name, dtype, dims, long_name, units = None, fill_value = None):
+        shape = [rootgrp.dimensions[d].size for d in dims[1:]]
+        # Size the chunks so each holds roughly CHUNK_BYTES of data
+        row_bytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        rows = int(max(1, min(rootgrp.dimensions[dims[0]].size, CHUNK_BYTES // row_bytes)))
+        kwargs = {}
+        if dtype.kind != 'U':
+            kwargs = {'zlib': True, 'complevel': complevel, 'chunksizes': [rows] + shape}
+        variable = rootgrp.createVariable(name, str if dtype.kind == 'U' else dtype, dims,
+                                          fill_value = fill_value, **kwargs)
+        variable.long_name = long_name
+        if units is not None:
+            variable.units = units
+        return variable
+
+    variables = {}
+    for field in fields_out:
+        name = field['name']
+        dims = ['point'] + ([field_dims[name][0]] if name in field_dims else [])
+        # Lines are a special case. Instead we create a line index variable.
+        if name == 'line':
+            name = 'line_index'
+        variables[field['name']] = create_variable(name, field_dtype(field), dims,
+                                                   field['attributes'].get('NAME') or field['name'],
+                                                   field['attributes'].get('UNITS'),
+                                                   _null_value(field))
+
+    if crs is not None:
+        variables['lon'] = create_variable('longitude', np.dtype(np.float64), ['point'],
+                                           'Longitude', 'degrees East')
+        variables['lat'] = create_variable('latitude', np.dtype(np.float64), ['point'],
+                                           'Latitude', 'degrees North')
+
+    null_values = {field['name']: _null_value(field) for field in fields_out}
+
+    extents = {}
+    lines = np.array([], dtype = np.int64)
+
+    start = 0
+    for chunk in read_chunks(dat_file, fields, chunk_size):
+        end = start + len(chunk[fields[0]['name']])
+        if crs is not None:
+            lon, lat = transformer.transform(chunk[x_field], chunk[y_field])
+            chunk['lon'] = np.asarray(lon, dtype = np.float64)
+            chunk['lat'] = np.asarray(lat, dtype = np.float64)
+        for key, variable in variables.items():
+            variable[start:end] = chunk[key]
+        # Keep track of the geospatial extent, ignoring null values
+        for key in [x_field, y_field, elevation_field, 'lon', 'lat']:
+            if key not in variables or chunk[key].dtype.kind not in 'iuf':
+                continue
+            values = chunk[key]
+            if null_values.get(key) is not None:
+                values = values[values != null_values[key]]
+            if values.size == 0 or np.all(np.isnan(values)):
+                continue
+            extent = (np.nanmin(values), np.nanmax(values))
+            if key in extents:
+                extent = (min(extents[key][0], extent[0]), max(extents[key][1], extent[1]))
+            extents[key] = extent
+        if has_lines:
+            lines = np.union1d(lines, chunk['line'])
+        start = end
+
+    if has_lines:
+        # Now we are able to create the line variable as we know which lines
+        # we had data for
+        rootgrp.createDimension('line', len(lines))
+        line_field = [field for field in fields_out if field['name'] == 'line'][0]
+        line_var = create_variable('line', np.dtype(np.int64), ['line'],
+                                   line_field['attributes'].get('NAME') or 'Line number')
+        line_var[:] = lines
+        # Change the line index values from line numbers to indices into lines
+        line_index = variables['line']
+        for i in range(0, npoints, chunk_size):
+            j = min(i + chunk_size, npoints)
+            line_index[i:j] = np.searchsorted(lines, line_index[i:j])
+        line_index.long_name = 'Index of the line of each point in the line variable'
+
+    ## Add some key metadata information
+    rootgrp.setncattr('source', os.path.basename(dat_file))
+    if date_created is None:
+        date_created = str(datetime.datetime.utcnow())
+    rootgrp.setncattr('date_created', date_created)
+    if crs is not None:
+        rootgrp.setncattr('crs', crs_projected.name)
+        rootgrp.setncattr('crs_geographic', crs_geographic.name)
+
+    # Add some geospatial metdata
+    for key, name, units in [(x_field, 'east', 'm'), (y_field, 'north', 'm'),
+                             (elevation_field, 'vertical', 'm'),
+                             ('lon', 'lon', 'degrees East'),
+                             ('lat', 'lat', 'degrees North')]:
+        if key in extents:
+            rootgrp.setncattr('geospatial_{}_min'.format(name), extents[key][0])
+            rootgrp.setncattr('geospatial_{}_max'.format(name), extents[key][1])
+            rootgrp.setncattr('geospatial_{}_units'.format(name), units)
+
+    rootgrp.close()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Convert an ASEG-GDF2 .dat file into a netcdf point dataset")
+    parser.add_argument('infile', help = "Path to the .dat file")
+    parser.add_argument('outfile', help = "Path to the output netcdf file")
+    parser.add_argument('--dfn', help = "Path to the .dfn file. Defaults to the .dat file with a .dfn extension")
+    parser.add_argument('-c', '--chunk-size', type = int, default = 100000,
+                        help = "Number of rows read and written at a time")
+    parser.add_argument('--crs', type = int,
+                        help = "EPSG code of the projected coordinates. If given longitudes and latitudes are added")
+    parser.add_argument('--dimension', action = 'append', default = [],
+                        help = "Dimension name for an array field as FIELD=DIMENSION. Can be repeated")
+    parser.add_argument('--complevel', type = int, default = 4, help = "zlib compression level")
+    parser.add_argument('--date-created',
+                        help = "Fixed date_created attribute. Defaults to the current UTC time")
+    args = parser.parse_args()
+
+    dimensions = dict(item.split('=', 1) for item in args.dimension)
+
+    aseg_gdf2netcdf(args.infile, args.outfile, dfn_file = args.dfn, chunk_size = args.chunk_size,
+                    dimensions = dimensions, crs = args.crs, complevel = args.complevel,
+                    date_created = args.date_created)
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,18 @@
 A script for compiling individual conductivity probability maps netcdf files
 that are output by the garjmcmctdem inversion code into a single netcdf file.
 
+The files are streamed into an unlimited point dimension in fixed size batches
+so memory use depends on the batch size rather than the number of files.
+Variables that are the same for every point are detected as the files are read
+and are written once without the point dimension.
+
+Files can be read by a pool of worker processes. The results are still
+written by a single writer in file order so the output does not depend on the
+number of workers.
+
+usage: concatenate_netcdf_files.py indir outfile [-s SETTINGS] [-b BATCH_SIZE]
+                                   [-w WORKERS]
+
 ## N.B this currently cannot deal with compiling files with varying array lengths.
 For example if the user changed the number of layers, samples etc
 
@@ -33,210 +45,387 @@ import numpy as np
 import glob
 import yaml
 import datetime
+import argparse
+import time
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 from pyproj import CRS,Transformer
 
-# Find the file paths from the pmap directory
-indir = r"C:\Users\PCUser\Desktop\AEM\rjmcmc\nc_subset"
-yml_file = r"C:\Users\PCUser\OneDrive\GitHub\garjmcmctdem_utils\scripts\conversion\active\netcdf_settings.yml"
-nc_outfile = r"C:\temp\test.nc"
-
-fnames  = []
-
-for file in glob.glob(os.path.join(indir,"*.nc")):
-    fnames.append(file)
-
-n_files = len(fnames)
-
-# Now parse the yaml file
-
-settings = yaml.safe_load(open(yml_file))
-
-# We will use the first dataset as a template to get key information about
-# dimeension and variable sizes and shapes
-dataset = netCDF4.Dataset(fnames[0])
-
-# Create a dictionary for all variabes
-var_dict = {}
-
-# For each variable in our settings file get the short name, long name, units,
-# dimensions and create an empty array
-
-for key in settings["field_definitions"].keys():
-    var_dict[key] = settings["field_definitions"][key].copy()
-    # Lines are a special case
-    if key == 'line':
-        # Instead we create a line index variable. Our line varibale will be a dimension
-        # with length np.uniqe(lines)
-        shape = [n_files]
-        dtype = np.int
-        arr = np.zeros(shape = shape, dtype = dtype)
-        var_dict['line_index']  = {'values': arr, 'short_name': 'line_index'}
-    # For array variables
-    elif key in dataset.variables.keys():
-        var = dataset.variables[key]
-        shape = [n_files] + list(var.shape)
-        dtype = var.dtype
-        arr = np.zeros(shape = shape, dtype = dtype)
-        var_dict[key]['values'] = arr
-    # Special flag for longitude and latitudes if they aren't in the file
-    elif np.logical_or(key == 'lat',key == 'lon'):
-        shape = (n_files)
-        dtype = np.float64
-        arr = np.zeros(shape = shape, dtype = dtype)
-        var_dict[key]['values'] = arr
-
-    # For scalar variables
-    else:
-        try:
-            val = getattr(dataset, key)
-            shape = (n_files)
-            dtype = type(val)
-            arr = np.zeros(shape = shape, dtype = dtype)
-            var_dict[key]['values'] = arr
-        except AttributeError:
-            print(key, " is neither a scalar or variable. Check settings file")
-
-
-# Now we populate the arrays
-dataset = None
-for i, file in enumerate(fnames):
-    dataset = netCDF4.Dataset(file)
-
-    for key in var_dict:
-        print(key)
-        # We will deal with these later
-        if key == 'lat' or key == 'lon' or key == 'line':
-            pass
-        elif key == 'line_index':
-            # We will reindex at a later time
-            val = getattr(dataset, 'line')
-            var_dict[key]['values'][i] = val
-        elif len(var_dict[key]['values'].shape) == 1:
-            # Get the scalar
-            val = getattr(dataset, key)
-            var_dict[key]['values'][i] = val
+# Target size of the chunks along the point dimension in bytes
+CHUNK_BYTES = 4 * 1024**2
+
+def get_fields(dataset, settings):
+    """Use a template dataset to find how each field in the settings file is
+    stored in the pmap files, along with its shape and data type.
+
+    Parameters
+    ----------
+    dataset : object
+        netCDF4 dataset of a single pmap file
+    settings : dictionary
+        Parsed yaml settings file
+
+    Returns
+    -------
+    dictionary
+        Dictionary of fields with the settings definition, 'kind', 'shape'
+        and 'dtype' keys
+
+    """
+    fields = {}
+
+    for key in settings["field_definitions"].keys():
+        field = settings["field_definitions"][key].copy()
+        # Lines are a special case. Instead we create a line index variable.
+        # Our line varibale will be a dimension with length np.unique(lines)
+        if key == 'line':
+            field['shape'] = ()
+            field['dtype'] = np.dtype(np.int64)
+            fields[key] = field
+            field = {'short_name': 'line_index', 'kind': 'line',
+                     'shape': (), 'dtype': np.dtype(np.int64)}
+            fields['line_index'] = field
+            continue
+        # For array variables
+        elif key in dataset.variables.keys():
+            var = dataset.variables[key]
+            field['kind'] = 'variable'
+            field['shape'] = var.shape
+            field['dtype'] = var.dtype
+        # Special flag for longitude and latitudes if they aren't in the file
+        elif np.logical_or(key == 'lat',key == 'lon'):
+            field['kind'] = 'projected'
+            field['shape'] = ()
+            field['dtype'] = np.dtype(np.float64)
+        # For scalar variables
+        else:
+            try:
+                val = getattr(dataset, key)
+            except AttributeError:
+                print(key, " is neither a scalar or variable. Check settings file")
+                continue
+            field['kind'] = 'scalar'
+            field['shape'] = ()
+            field['dtype'] = np.asarray(val).dtype
+        fields[key] = field
+
+    # Make sure all dimensions entries are lists
+    for key in fields.keys():
+        if 'dimensions' not in fields[key].keys():
+            fields[key]['dimensions'] = []
+        elif isinstance(fields[key]['dimensions'], str):
+            fields[key]['dimensions'] = [fields[key]['dimensions']]
+        else:
+            fields[key]['dimensions'] = list(fields[key]['dimensions'])
+
+    return fields
+
+def read_sounding(fname, fields):
+    """Read the fields for a single pmap file.
+
+    Parameters
+    ----------
+    fname : string
+        Path to the pmap netcdf file
+    fields : dictionary
+        Dictionary of fields from get_fields
+
+    Returns
+    -------
+    dictionary
+        Dictionary with the value of each field that is read from file
+
+    """
+    values = {}
+
+    with netCDF4.Dataset(fname) as dataset:
+        for key, field in fields.items():
+            kind = field.get('kind')
+            if kind == 'line':
+                # We will reindex once we know all of the lines
+                values[key] = getattr(dataset, 'line')
+            elif kind == 'scalar':
+                values[key] = getattr(dataset, key)
+            elif kind == 'variable':
+                values[key] = dataset.variables[key][:]
+    return values
+
+class FieldWriter:
+    """Writes a single field to the output file a batch at a time.
+
+    The field is held as a constant until a point with a different value is
+    found. At this point a variable with the point dimension is created and
+    the preceding points are backfilled with the constant value.
+    """
+    def __init__(self, rootgrp, field, batch_size):
+        self.rootgrp = rootgrp
+        self.field = field
+        self.batch_size = batch_size
+        self.shape = tuple(field['shape'])
+        self.dtype = field['dtype']
+        self.constant = None
+        self.variable = None
+        self.npoints = 0
+        self.min = None
+        self.max = None
+
+    @property
+    def is_constant(self):
+        return self.variable is None
+
+    def create_variable(self, dimensions, **kwargs):
+        short_name = self.field['short_name']
+        # Fall back on the short name if no long name has been defined
+        long_name = self.field.get('long_name') or short_name
+        dtype = str if self.dtype.kind == 'U' else self.dtype
+        variable = self.rootgrp.createVariable(short_name, dtype, dimensions, **kwargs)
+        variable.long_name = long_name
+        # Add units
+        if 'units' in self.field.keys():
+            variable.units = self.field['units']
+        return variable
+
+    def _create_point_variable(self):
+        # Size the chunks so each holds roughly CHUNK_BYTES of data
+        row_bytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        rows = int(max(1, min(self.batch_size, CHUNK_BYTES // row_bytes)))
+        chunksizes = [rows] + list(self.shape) if self.dtype.kind != 'U' else None
+        self.variable = self.create_variable(['point'] + self.field['dimensions'],
+                                             chunksizes = chunksizes)
+        # Backfill the points that were read while the field was constant
+        for start in range(0, self.npoints, self.batch_size):
+            end = min(start + self.batch_size, self.npoints)
+            self.variable[start:end] = np.broadcast_to(self.constant,
+                                                       (end - start,) + self.shape)
+
+    def append(self, values):
+        """Add a batch of values with shape (n,) + field shape."""
+        n = values.shape[0]
+        if n == 0:
+            return
+        if self.dtype.kind in 'biuf':
+            batch_min, batch_max = np.nanmin(values), np.nanmax(values)
+            self.min = batch_min if self.min is None else min(self.min, batch_min)
+            self.max = batch_max if self.max is None else max(self.max, batch_max)
+        if self.is_constant:
+            if self.constant is None:
+                self.constant = values[0].copy()
+            # If all values are the same we can represent the variable as a scalar
+            if np.all(values == self.constant):
+                self.npoints += n
+                return
+            self._create_point_variable()
+        self.variable[self.npoints:self.npoints + n] = values
+        self.npoints += n
+
+    def close(self):
+        """Write the field as a single value if it was constant for all points."""
+        if not self.is_constant or self.constant is None:
+            return
+        dims = self.field['dimensions']
+        self.variable = self.create_variable(dims)
+        if len(dims) == 0:
+            self.variable[:] = self.constant
+            # Also make a attribute for ease of use
+            self.rootgrp.setncattr(self.field['short_name'], self.constant)
         else:
-            # Get the variable
-            arr = dataset.variables[key][:]
-            var_dict[key]['values'][i] = arr
-# Now we are able to create the line variable as we know which lines we are
-# had data for
-
-lines = np.unique(var_dict['line_index']['values'])
-var_dict['line']['values'] = lines
-# Now we want to change the line index values to index lines
-
-
-for i, line in enumerate(lines):
-    inds = np.where(var_dict['line_index']['values']== line)
-    var_dict['line_index']['values'][inds] = i
-
-
-# Now we get our longitudes and latitudes using the crs defined in the settings file
-crs_projected = CRS.from_epsg(settings['crs']['projected']['epsg'])
-crs_geographic = CRS.from_epsg(settings['crs']['geographic']['epsg'])
-
-transformer = Transformer.from_crs(crs_projected, crs_geographic, always_xy=True)
-
-lon, lat = transformer.transform(var_dict['x']['values'],var_dict['y']['values'])
-
-var_dict['lon']['values'] = lon
-var_dict['lat']['values'] = lat
-
-# Now we want to create a dimensions dictionary with field names and sizes
-
-dim_dict = {}
-
-for key in settings['dimension_fields'].keys():
-    dim_dict[key] = settings['dimension_fields'][key].copy()
-    if key == 'line':
-        dim_dict[key]['size'] = len(var_dict['line']['values'])
-    else:
-        dim_dict[key]['size'] = dataset.dimensions[key].size
-dim_dict
-# Refine the dimension definition
-
-for key in var_dict.keys():
-    # make sure all dimensions dictoinary entries are lists
-    if 'dimensions' not in var_dict[key].keys():
-        var_dict[key]['dimensions'] = []
-    elif isinstance(var_dict[key]['dimensions'], str):
-        var_dict[key]['dimensions'] = [var_dict[key]['dimensions']]
-    # Extract the arrays
-    arr = var_dict[key]['values']
-    # If all array values are the same we can represent the variable as a scalar
-    if len(np.unique(arr)) == 1:
-        var_dict[key]['values'] = var_dict[key]['values'][0]
-    # If we can reduce the first axis, then the variables are the same across all
-    # points and we can remove this redundant axis
-    elif np.all(np.unique(var_dict[key]['values'],axis = 0) == var_dict[key]['values'][0]):
-        var_dict[key]['values'] = var_dict[key]['values'][0]
-    # Otherwise add the point dimension to the front of the dimensions
-    else:
-        var_dict[key]['dimensions'].insert(0, 'point')
-
-var_dict['line']['dimensions'] = 'line'
-
-
-# Now we create a new netcdf file
-
-rootgrp = netCDF4.Dataset(nc_outfile, "w", format="NETCDF4")
-
-point = rootgrp.createDimension("point", None)
-
-for key in dim_dict:
-    size = dim_dict[key]['size']
-    dim_name = dim_dict[key]['dimension_name']
-    _ = rootgrp.createDimension(dim_name, size)
-
-# Now add the variables
-
-nc_vars = {}
-
-for key in var_dict.keys():
-    dat = var_dict[key]['values']
-    dims = var_dict[key]['dimensions']
-    dtype = dat.dtype
-    short_name = var_dict[key]['short_name']
-    long_name = var_dict[key]['short_name']
-    if len(dims) == 0:
-        nc_vars[key] = rootgrp.createVariable(short_name,dtype)
-        nc_vars[key][:] = dat
-        # Also make a attribute for ease of use
-        rootgrp.setncattr(short_name, dat)
-
-    else:
-        nc_vars[key] = rootgrp.createVariable(short_name,dtype,dims)
-        nc_vars[key][:] = dat
-    nc_vars[key].long_name = long_name
-    # Add units
-    if 'units' in var_dict[key].keys():
-        nc_vars[key].units = var_dict[key]['units']
-
-## Add some key metadata information
-
-rootgrp.setncattr("value_parameterization",dataset.value_parameterization)
-rootgrp.setncattr("position_parameterization",dataset.position_parameterization)
-rootgrp.setncattr('keywords', settings['keywords'])
-rootgrp.setncattr('date_created', str(datetime.datetime.utcnow()))
-rootgrp.setncattr('crs', crs_projected.name)
-rootgrp.setncattr('crs_geographic',crs_geographic.name)
-
-# Add some geospatial metdata
-rootgrp.setncattr('geospatial_east_min', np.min(var_dict['x']['values']))
-rootgrp.setncattr('geospatial_east_max', np.max(var_dict['x']['values']))
-rootgrp.setncattr('geospatial_east_units', 'm')
-rootgrp.setncattr('geospatial_north_min', np.min(var_dict['y']['values']))
-rootgrp.setncattr('geospatial_north_max', np.max(var_dict['y']['values']))
-rootgrp.setncattr('geospatial_north_units', 'm')
-rootgrp.setncattr('geospatial_vertical_min', np.min(var_dict['elevation']['values']))
-rootgrp.setncattr('geospatial_vertical_max', np.max(var_dict['elevation']['values']))
-rootgrp.setncattr('geospatial_vertical_units', 'm')
-rootgrp.setncattr('geospatial_lon_min', np.min(var_dict['lon']['values']))
-rootgrp.setncattr('geospatial_lon_max', np.max(var_dict['lon']['values']))
-rootgrp.setncattr('geospatial_lont_units', 'degrees East')
-rootgrp.setncattr('geospatial_lat_min', np.min(var_dict['lat']['values']))
-rootgrp.setncattr('geospatial_lon_max', np.max(var_dict['lat']['values']))
-rootgrp.setncattr('geospatial_lont_units', 'degrees North')
-
-rootgrp.close()
+            self.variable[:] = self.constant
+
+def stack_batch(soundings, fields, transformer):
+    """Stack a list of sounding dictionaries into arrays for each field."""
+    batch = {}
+    for key, field in fields.items():
+        if field.get('kind') in ['line', 'scalar', 'variable']:
+            batch[key] = np.array([sounding[key] for sounding in soundings],
+                                  dtype = field['dtype'])
+    # Now we get our longitudes and latitudes using the crs defined in the settings file
+    if 'lon' in fields or 'lat' in fields:
+        lon, lat = transformer.transform(batch['x'], batch['y'])
+        batch['lon'] = np.asarray(lon, dtype = np.float64)
+        batch['lat'] = np.asarray(lat, dtype = np.float64)
+    return batch
+
+def reindex_lines(variable, lines, batch_size):
+    """Change the line index values from line numbers to indices into lines."""
+    for start in range(0, variable.shape[0], batch_size):
+        end = min(start + batch_size, variable.shape[0])
+        variable[start:end] = np.searchsorted(lines, variable[start:end])
+
+def read_batches(fnames, fields, batch_size, n_workers = 1):
+    """Generator that yields lists of sounding dictionaries in file order.
+
+    If n_workers is greater than 1 the files are read by a process pool and the
+    next batch is submitted before the current batch is yielded, so the files
+    are read while the current batch is written.
+    """
+    starts = range(0, len(fnames), batch_size)
+
+    if n_workers <= 1:
+        for start in starts:
+            yield [read_sounding(fname, fields) for fname in fnames[start:start + batch_size]]
+        return
+
+    with ProcessPoolExecutor(max_workers = n_workers) as executor:
+
+        def submit(start):
+            batch_fnames = fnames[start:start + batch_size]
+            chunksize = max(1, len(batch_fnames) // (4 * n_workers))
+            # Executor.map returns the results in the order they were submitted
+            return executor.map(read_sounding, batch_fnames, repeat(fields),
+                                chunksize = chunksize)
+
+        pending = None
+        for start in starts:
+            results = submit(start)
+            if pending is not None:
+                yield list(pending)
+            pending = results
+        if pending is not None:
+            yield list(pending)
+
+def concatenate_files(fnames, nc_outfile, settings, batch_size = 1000, n_workers = 1,
+                      date_created = None):
+    """Compile pmap netcdf files into a single netcdf file.
+
+    Parameters
+    ----------
+    fnames : list
+        List of pmap netcdf file paths. Points are written in this order
+    nc_outfile : string
+        Path to the output netcdf file
+    settings : dictionary
+        Parsed yaml settings file
+    batch_size : int
+        Number of files to read before writing to the output file
+    n_workers : int
+        Number of processes used to read the files. If 1 the files are read
+        by the writing process
+    date_created : string
+        Value of the date_created attribute. Defaults to the UTC modification
+        time of the newest input file, so identical inputs give identical
+        files
+
+    """
+    n_files = len(fnames)
+
+    if n_files == 0:
+        raise ValueError("No netcdf files to concatenate")
+
+    # We will use the first dataset as a template to get key information about
+    # dimension and variable sizes and shapes
+    with netCDF4.Dataset(fnames[0]) as dataset:
+        fields = get_fields(dataset, settings)
+        # Now we want to create a dimensions dictionary with field names and sizes
+        dim_dict = {}
+        for key in settings['dimension_fields'].keys():
+            dim_dict[key] = settings['dimension_fields'][key].copy()
+            if key != 'line':
+                dim_dict[key]['size'] = dataset.dimensions[key].size
+        metadata = {key: getattr(dataset, key) for key in ["value_parameterization",
+                                                          "position_parameterization"]}
+
+    crs_projected = CRS.from_epsg(settings['crs']['projected']['epsg'])
+    crs_geographic = CRS.from_epsg(settings['crs']['geographic']['epsg'])
+
+    transformer = Transformer.from_crs(crs_projected, crs_geographic, always_xy=True)
+
+    # Now we create a new netcdf file
+    rootgrp = netCDF4.Dataset(nc_outfile, "w", format="NETCDF4")
+
+    point = rootgrp.createDimension("point", None)
+
+    for key in dim_dict:
+        # The line dimension is created once we know all of the lines
+        if key != 'line':
+            _ = rootgrp.createDimension(dim_dict[key]['dimension_name'], dim_dict[key]['size'])
+
+    writers = {key: FieldWriter(rootgrp, field, batch_size) for key, field in fields.items()
+               if 'kind' in field}
+
+    # The line index is always stored for each point
+    writers['line_index']._create_point_variable()
+
+    lines = np.array([], dtype = np.int64)
+
+    t0 = time.time()
+    n_written = 0
+
+    for soundings in read_batches(fnames, fields, batch_size, n_workers):
+        batch = stack_batch(soundings, fields, transformer)
+        for key, writer in writers.items():
+            writer.append(batch[key])
+        lines = np.union1d(lines, batch['line_index'])
+        n_written += len(soundings)
+        print("Written {} of {} files ({:.1f} files/s)".format(n_written, n_files,
+                                                              n_written / (time.time() - t0)))
+
+    for writer in writers.values():
+        writer.close()
+
+    # Now we are able to create the line variable as we know which lines we
+    # had data for
+    _ = rootgrp.createDimension(dim_dict['line']['dimension_name'], len(lines))
+    line_writer = FieldWriter(rootgrp, fields['line'], batch_size)
+    line_var = line_writer.create_variable([dim_dict['line']['dimension_name']])
+    line_var[:] = lines
+
+    # Now we want to change the line index values to index lines
+    reindex_lines(writers['line_index'].variable, lines, batch_size)
+
+    ## Add some key metadata information
+    for key, value in metadata.items():
+        rootgrp.setncattr(key, value)
+    rootgrp.setncattr('keywords', settings['keywords'])
+    if date_created is None:
+        newest = max(os.path.getmtime(fname) for fname in fnames)
+        date_created = str(datetime.datetime.utcfromtimestamp(newest))
+    rootgrp.setncattr('date_created', date_created)
+    rootgrp.setncattr('crs', crs_projected.name)
+    rootgrp.setncattr('crs_geographic',crs_geographic.name)
+
+    # Add some geospatial metdata
+    for key, name, units in [('x', 'east', 'm'), ('y', 'north', 'm'),
+                             ('elevation', 'vertical', 'm'),
+                             ('lon', 'lon', 'degrees East'),
+                             ('lat', 'lat', 'degrees North')]:
+        if key in writers and writers[key].min is not None:
+            rootgrp.setncattr('geospatial_{}_min'.format(name), writers[key].min)
+            rootgrp.setncattr('geospatial_{}_max'.format(name), writers[key].max)
+            rootgrp.setncattr('geospatial_{}_units'.format(name), units)
+
+    rootgrp.close()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compile garjmcmctdem pmap netcdf files into a single netcdf file")
+    parser.add_argument('indir', help = "Directory containing the pmap netcdf files")
+    parser.add_argument('outfile', help = "Path to the output netcdf file")
+    parser.add_argument('-s', '--settings',
+                        default = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                               'netcdf_settings.yml'),
+                        help = "yaml file with the field and dimension definitions")
+    parser.add_argument('-b', '--batch-size', type = int, default = 1000,
+                        help = "Number of files to read before writing to the output file")
+    parser.add_argument('-w', '--workers', type = int, default = 1,
+                        help = "Number of processes used to read the pmap files")
+    parser.add_argument('--date-created',
+                        help = "Fixed date_created attribute. Defaults to the UTC modification "
+                               "time of the newest pmap file")
+    parser.add_argument('-p', '--pattern', default = "*.nc",
+                        help = "Glob pattern for the pmap files within indir")
+    args = parser.parse_args()
+
+    # Find the file paths from the pmap directory. These are sorted so the output
+    # does not depend on the file system order
+    outfile = os.path.abspath(args.outfile)
+    fnames = sorted(file for file in glob.glob(os.path.join(args.indir, args.pattern))
+                    if os.path.abspath(file) != outfile)
+
+    # Now parse the yaml file
+    with open(args.settings) as f:
+        settings = yaml.safe_load(f)
+
+    concatenate_files(fnames, args.outfile, settings, batch_size = args.batch_size,
+                      n_workers = args.workers, date_created = args.date_created)
+
+if __name__ == "__main__":
+    main()
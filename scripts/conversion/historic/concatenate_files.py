@@ -1,33 +1,180 @@
 # Concatenating rjmcmc.dat files from a directory structure
+#
+# usage: python concatenate_files.py indir [--append] [--workers N]
+#
+# The files are combined in sorted path order into indir/combined/rjmcmc.dat.
+# A manifest of the combined files is kept alongside so that with --append
+# only files from new run directories are added to the existing combined file.
+#
+# The manifest also records the size and modification time of the combined
+# file as it was written. --append is refused if the file has changed since,
+# e.g. by fix_rjmcmctdem_file.py or remove_duplicates.py, as raw rows can't be
+# appended to a file with widened columns. So --append must come before those
+# steps; once they have been run, rebuild the combined file without --append
+# and run them again.
 
 import os, sys, shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
-indir = sys.argv[1]
+# Size of the buffer used to copy file contents
+COPY_BUFFER = 16 * 1024**2
 
-new_dir = os.path.join(indir, 'combined')
+def _walk(directory, filename, exclude):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        # Don't descend into the excluded directories
+        dirnames[:] = [d for d in dirnames
+                       if os.path.abspath(os.path.join(dirpath, d)) not in exclude]
+        if filename in filenames:
+            paths.append(os.path.join(dirpath, filename))
+    return paths
 
-if not os.path.exists(new_dir):
-    os.mkdir(new_dir)
+def find_files(indir, filename, exclude = (), n_workers = 8):
+    """Find files with a given name in a directory structure, walking the top
+    level subdirectories in parallel.
 
-outfile = os.path.join(new_dir, 'rjmcmc.dat')
+    Parameters
+    ----------
+    indir : string
+        Directory to search
+    filename : string
+        Name of the files to find, e.g. 'rjmcmc.dat'
+    exclude : sequence
+        Directories that are not searched
+    n_workers : integer
+        Number of threads used to walk the subdirectories
 
-if os.path.exists(outfile):
-    os.remove(outfile)
+    Returns
+    -------
+    list
+        Sorted list of file paths relative to indir
 
-s = ''
+    """
+    exclude = set(os.path.abspath(d) for d in exclude)
 
-# Iterate
-for dirpath, dirnames, filenames in os.walk(os.path.join(indir, ".")):
-    for filename in [f for f in filenames if f == "rjmcmc.dat"]:
-        with open(os.path.join(dirpath, filename), 'r') as infile:
-            s += infile.read()
-        
-with open(outfile, 'w') as f:
-    f.write(s)
-    
-if not os.path.exists(outfile.replace('.dat', '.dfn')):
-    for dirpath, dirnames, filenames in os.walk(os.path.join(indir, ".")):
-        for filename in [f for f in filenames if f == "rjmcmc.dfn"]:
-            shutil.copyfile(os.path.join(dirpath, filename),
-                            os.path.join(new_dir, filename))
-            break
\ No newline at end of file
+    entries = list(os.scandir(indir))
+
+    paths = [entry.path for entry in entries if entry.is_file() and entry.name == filename]
+
+    subdirs = [entry.path for entry in entries if entry.is_dir() and
+               os.path.abspath(entry.path) not in exclude]
+
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        for subdir_paths in executor.map(lambda d: _walk(d, filename, exclude), subdirs):
+            paths += subdir_paths
+
+    return sorted(os.path.relpath(path, indir) for path in paths)
+
+def _file_stamp(path):
+    # Size and modification time recorded in the manifest
+    stat = os.stat(path)
+    return "# size={} mtime_ns={}".format(stat.st_size, stat.st_mtime_ns)
+
+def read_manifest(manifest_file):
+    """Read the list of files that have already been combined.
+
+    Parameters
+    ----------
+    manifest_file : string
+        Path to the manifest
+
+    Returns
+    -------
+    files, stamp
+        List of the combined files and the last recorded size and
+        modification time of the combined file, or None if there isn't one
+
+    """
+    if not os.path.exists(manifest_file):
+        return [], None
+    files, stamp = [], None
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('#'):
+                stamp = line
+            elif line.strip():
+                files.append(line)
+    return files, stamp
+
+def concatenate_files(indir, append = False, n_workers = 8):
+    """Concatenate the rjmcmc.dat files in a directory structure into
+    indir/combined/rjmcmc.dat, streaming each file to the output.
+
+    Parameters
+    ----------
+    indir : string
+        Directory containing the inversion run directories
+    append : boolean
+        If True only files that are not in the manifest of the existing
+        combined file are appended to it. A ValueError is raised if the
+        combined file has no manifest or has changed since it was written
+    n_workers : integer
+        Number of threads used to walk the directory structure
+
+    Returns
+    -------
+    list
+        Files that were added to the combined file
+
+    """
+    new_dir = os.path.join(indir, 'combined')
+
+    if not os.path.exists(new_dir):
+        os.mkdir(new_dir)
+
+    outfile = os.path.join(new_dir, 'rjmcmc.dat')
+    manifest_file = os.path.join(new_dir, 'rjmcmc.manifest')
+
+    infiles = find_files(indir, "rjmcmc.dat", exclude = [new_dir], n_workers = n_workers)
+
+    if append and os.path.exists(outfile):
+        # Without a manifest we can't tell which files are already combined
+        if not os.path.exists(manifest_file):
+            raise ValueError("{} has no manifest of the combined files. Run without "
+                             "append to rebuild it".format(outfile))
+        combined, stamp = read_manifest(manifest_file)
+        # The file must not have been changed since it was written
+        if stamp != _file_stamp(outfile):
+            raise ValueError("{} has changed since it was combined, e.g. by fix_rjmcmctdem_file.py "
+                             "or remove_duplicates.py. Run without append to rebuild it".format(outfile))
+        combined = set(combined)
+        infiles = [f for f in infiles if f not in combined]
+        mode = 'ab'
+    else:
+        mode = 'wb'
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+
+    # Stream each file to the output and record it in the manifest
+    with open(outfile, mode) as outf, open(manifest_file, 'a') as manifest:
+        for infile in infiles:
+            with open(os.path.join(indir, infile), 'rb') as inf:
+                shutil.copyfileobj(inf, outf, COPY_BUFFER)
+            outf.flush()
+            manifest.write(infile + '\n')
+
+    # Record the combined file as written
+    with open(manifest_file, 'a') as manifest:
+        manifest.write(_file_stamp(outfile) + '\n')
+
+    if not os.path.exists(outfile.replace('.dat', '.dfn')):
+        dfn_files = find_files(indir, "rjmcmc.dfn", exclude = [new_dir], n_workers = n_workers)
+        if len(dfn_files) > 0:
+            shutil.copyfile(os.path.join(indir, dfn_files[0]),
+                            os.path.join(new_dir, "rjmcmc.dfn"))
+
+    return infiles
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Concatenate rjmcmc.dat files from a directory structure")
+    parser.add_argument('indir', help = "Directory containing the inversion run directories")
+    parser.add_argument('--append', action = 'store_true',
+                        help = "Only append files that are not already in the combined file")
+    parser.add_argument('--workers', type = int, default = 8,
+                        help = "Number of threads used to walk the directory structure")
+    args = parser.parse_args()
+
+    infiles = concatenate_files(args.indir, append = args.append, n_workers = args.workers)
+    print("Combined {} files".format(len(infiles)))
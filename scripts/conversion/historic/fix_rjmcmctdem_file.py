@@ -1,39 +1,270 @@
 # Fix fixed-width delimiter errors in rjmcmctdem.dat
-# This is caused by long run times giving sample times of 
-# >10**4 seconds
-import sys, os
+# These are caused by values that fill or overflow the width declared in the
+# .dfn file, e.g. long run times giving sample times of >10**4 seconds. Such
+# values touch or push into the neighbouring column so the file can no longer
+# be read.
+#
+# The .dfn file is parsed and each row of the .dat file is split into values
+# using the declared widths and formats. The .dat file is read twice, as the
+# new widths must be known before any row can be rewritten. A first scan finds
+# the fields that need to be wider, then a second pass rewrites every row with
+# all of the widened fields at once. The .dfn file is then rewritten once with
+# the new widths. Rows that are narrower than the declared layout, e.g. raw
+# rows appended to a fixed file, are also rewritten to the new widths. Files
+# that need no changes are only scanned.
+#
+# usage: python fix_rjmcmctdem_file.py file1.dat [file2.dat ...] [--workers N]
+#                                      [--dry-run]
 
-infile = sys.argv[1]
+import os, re, sys, operator
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-outfile = infile.replace(".dat", "_fixed.dat")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
 
-with open(infile, 'r' ) as inf:
-    with open(outfile, 'w') as outf:
-        for line in inf:
-            new_line = line[:136] + ' ' + line[136:]
-            outf.write(new_line)
+from aseg_gdf2_utils import FORMAT_SPEC, parse_dfn
+
+_nan_inf = r"[-+]?(?:nan|inf(?:inity)?)"
+
+def _value_regex(field):
+    # Regular expression for a single value of a field
+    d = field['decimals']
+    if field['type'] == 'A':
+        return re.compile(".{%d}" % field['width'])
+    if field['type'] == 'I':
+        number = r"[-+]?\d+"
+    elif field['type'] == 'F':
+        number = r"[-+]?\d*\.\d{%d}" % d if d > 0 else r"[-+]?\d+\.?"
+    else:
+        # Only take a three digit exponent if it isn't touching the next value
+        number = r"[-+]?\d*\.\d{%d}[ED][-+]?(?:\d{3}(?=\s|$)|\d{2})" % d
+    return re.compile(r"\s*(?:%s|%s)" % (number, _nan_inf), re.IGNORECASE)
+
+def column_layout(fields):
+    """Get the declared layout of the columns of a .dat file.
+
+    Parameters
+    ----------
+    fields : list
+        Fields from parse_dfn
+
+    Returns
+    -------
+    dictionary
+        Dictionary with the 'field' (field number), 'width', 'regex' and
+        'slice' of each column, the start positions of the numeric columns
+        and the total width of a row
+
+    """
+    layout = {'field': [], 'width': [], 'regex': [], 'slice': [], 'numeric_starts': []}
+    start = 0
+    for i, field in enumerate(fields):
+        regex = _value_regex(field)
+        for _ in range(field['count']):
+            layout['field'].append(i)
+            layout['width'].append(field['width'])
+            layout['regex'].append(regex)
+            layout['slice'].append(slice(start, start + field['width']))
+            if field['type'] != 'A':
+                layout['numeric_starts'].append(start)
+            start += field['width']
+    layout['total_width'] = start
+    return layout
+
+def split_row(row, layout):
+    """Split a row of a .dat file into its values.
+
+    Each value starts where the previous one ended, as the values are written
+    with their declared widths, but values that overflow their width push the
+    rest of the row to the right. Rows of the declared length are sliced
+    directly; other rows are parsed value by value.
+
+    Parameters
+    ----------
+    row : string
+        Row without the line ending
+    layout : dictionary
+        Layout from column_layout
+
+    Returns
+    -------
+    list
+        The values, including their leading spaces
+
+    """
+    if len(row) == layout['total_width']:
+        return [row[s] for s in layout['slice']]
+
+    values = []
+    start = 0
+    for width, regex in zip(layout['width'], layout['regex']):
+        value = row[start:start + width]
+        if regex.fullmatch(value) is None:
+            # The value overflows its width
+            match = regex.match(row, start)
+            if match is None:
+                raise ValueError("Unable to parse value at position {}".format(start))
+            value = match.group(0)
+        values.append(value)
+        start += len(value)
+
+    if row[start:].strip():
+        raise ValueError("Unexpected characters at position {}".format(start))
+
+    return values
+
+def find_required_widths(dat_file, fields, layout = None):
+    """Scan a .dat file for the width each field needs so that every value is
+    separated from the previous value by at least one space.
+
+    Parameters
+    ----------
+    dat_file : string
+        Path to the .dat file
+    fields : list
+        Fields from parse_dfn
+    layout : dictionary
+        Layout from column_layout. Created from the fields if None
+
+    Returns
+    -------
+    widths, n_irregular
+        Required width for each field, which is the declared width unless
+        some values fill or overflow it, and the number of rows whose length
+        differs from the declared row width
 
-# Now remove the old files and rename the new
+    """
+    if layout is None:
+        layout = column_layout(fields)
 
-os.remove(infile)
+    numeric = [fields[i]['type'] != 'A' for i in layout['field']]
+    column_widths = list(layout['width'])
 
-os.rename(outfile, infile)
+    get_starts = operator.itemgetter(*layout['numeric_starts']) if len(layout['numeric_starts']) > 0 else None
+    blank = tuple(' ' * len(layout['numeric_starts']))
+    n_irregular = 0
 
-# Now chenge the .dfn file
+    with open(dat_file, 'r') as f:
+        for i, line in enumerate(f):
+            row = line.rstrip('\r\n')
+            # Most rows have every numeric value fitting within its width
+            if len(row) == layout['total_width'] and (get_starts is None or
+                                                      tuple(get_starts(row)) == blank):
+                continue
+            if len(row) != layout['total_width']:
+                n_irregular += 1
+            try:
+                values = split_row(row, layout)
+            except ValueError as e:
+                raise ValueError("Line {} of {}: {}".format(i + 1, dat_file, e))
+            for j, value in enumerate(values):
+                # Numeric values need a leading space to separate them
+                required = len(value) + (numeric[j] and not value[:1].isspace())
+                if required > column_widths[j]:
+                    column_widths[j] = required
 
-infile = infile.replace('.dat', '.dfn')
+    widths = [field['width'] for field in fields]
+    for j, width in enumerate(column_widths):
+        widths[layout['field'][j]] = max(widths[layout['field'][j]], width)
 
-outfile = infile.replace(".dfn", "_fixed.dfn")
+    return widths, n_irregular
+
+def rewrite_dat(dat_file, outfile, fields, widths, layout = None):
+    """Rewrite a .dat file with each value right justified to the new widths."""
+    if layout is None:
+        layout = column_layout(fields)
+
+    column_widths = [widths[i] for i in layout['field']]
+
+    with open(dat_file, 'r') as inf:
+        with open(outfile, 'w') as outf:
+            for line in inf:
+                row = line.rstrip('\r\n')
+                values = split_row(row, layout)
+                outf.write(''.join(v.rjust(w) for v, w in zip(values, column_widths)) +
+                           line[len(row):])
+
+def rewrite_dfn(dfn_file, outfile, fields, widths):
+    """Rewrite a .dfn file with the new field widths."""
+    new_formats = {}
+    for field, width in zip(fields, widths):
+        if width != field['width']:
+            new_format = FORMAT_SPEC.sub(lambda m: "{}{}{}{}".format(m.group(1), m.group(2), width,
+                                                                     '.' + m.group(4) if m.group(4) else ''),
+                                         field['format'])
+            new_formats[field['line']] = (field['format'], new_format)
+
+    with open(dfn_file, 'r') as inf:
+        lines = inf.readlines()
+
+    for i, (old_format, new_format) in new_formats.items():
+        prefix, body = lines[i].split(';', 1)
+        parts = body.split(':')
+        parts[1] = parts[1].replace(old_format, new_format, 1)
+        lines[i] = prefix + ';' + ':'.join(parts)
 
-with open(infile, 'r') as inf:
     with open(outfile, 'w') as outf:
-        s = inf.read()
-        outf.write(s.replace('sampletime : F8.2', 'sampletime : F9.2'))
-        outf.write(s.replace('misfit_lowest : E10.6', 'misfit_lowest : E15.6'))
-        outf.write(s.replace('misfit_average : E10.6', 'misfit_average : E15.6'))
+        outf.writelines(lines)
+
+def fix_file(dat_file, dry_run = False):
+    """Fix the fixed-width errors in a .dat file and its .dfn file in place.
+
+    Parameters
+    ----------
+    dat_file : string
+        Path to the .dat file. The .dfn file must have the same name
+    dry_run : boolean
+        If True the files are scanned but not changed
+
+    Returns
+    -------
+    changes, n_irregular
+        Dictionary of the fields that were widened with their old and new
+        widths, and the number of rows that did not have the declared row
+        width. The .dat file is rewritten if either is non-zero, as rows
+        that are narrower than the declared layout (e.g. raw rows appended
+        to a fixed file) are padded to the new widths too
+
+    """
+    dfn_file = dat_file.replace('.dat', '.dfn')
+
+    fields = parse_dfn(dfn_file)
+    layout = column_layout(fields)
+
+    widths, n_irregular = find_required_widths(dat_file, fields, layout)
+
+    changes = {field['name']: (field['width'], width) for field, width in zip(fields, widths)
+               if width != field['width']}
+
+    if (len(changes) == 0 and n_irregular == 0) or dry_run:
+        return changes, n_irregular
+
+    # Write the fixed files then replace the old ones
+    dat_outfile = dat_file.replace(".dat", "_fixed.dat")
+    dfn_outfile = dfn_file.replace(".dfn", "_fixed.dfn")
+
+    rewrite_dat(dat_file, dat_outfile, fields, widths, layout)
+    rewrite_dfn(dfn_file, dfn_outfile, fields, widths)
+
+    os.replace(dat_outfile, dat_file)
+    os.replace(dfn_outfile, dfn_file)
 
-# Now remove the old files and rename the new
+    return changes, n_irregular
 
-os.remove(infile)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Fix fixed-width errors in ASEG-GDF2 .dat files")
+    parser.add_argument('infiles', nargs = '+', help = ".dat files to fix")
+    parser.add_argument('--workers', type = int, default = 1,
+                        help = "Number of files to process in parallel")
+    parser.add_argument('--dry-run', action = 'store_true',
+                        help = "Report the fields that need widening and the rows with the wrong "
+                               "width without changing the files")
+    args = parser.parse_args()
 
-os.rename(outfile, infile)
\ No newline at end of file
+    with ProcessPoolExecutor(max_workers = args.workers) as executor:
+        results = executor.map(fix_file, args.infiles, [args.dry_run] * len(args.infiles))
+        for infile, (changes, n_irregular) in zip(args.infiles, results):
+            for name, (old_width, new_width) in changes.items():
+                print("{}: {} width {} -> {}".format(infile, name, old_width, new_width))
+            if n_irregular > 0:
+                print("{}: {} rows do not have the .dfn row width".format(infile, n_irregular))
@@ -1,70 +1,90 @@
 # A script for mapping points from the rjmcmc.dat file to their pmap matlab files
+#
+# usage: python pmap_mapper.py infile.dat pmap_dir
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import aseg_gdf2
-from shapely.geometry import Point
 import sys
 import glob
 import os
 
-#load file as pandas dataframe using .dfn file
+def get_pmap_files(pmap_dir):
+    """Find the pmap files in a directory and index them on the fiducial,
+    rounded to one decimal place, and unique id from the naming convention.
 
-infile = sys.argv[1]
-pmap_dir = sys.argv[2]
+    Parameters
+    ----------
+    pmap_dir : string
+        Directory containing the pmap .mat files
 
-dat = aseg_gdf2.read(infile)
+    Returns
+    -------
+    dataframe
+        Dataframe with 'fid_key', 'uniqueid_key' and 'matfile' columns. Where
+        several files have the same key only the last one found is kept
 
-df_AEM = dat.df()
+    """
+    records = []
 
-xs = df_AEM['easting '].values
-ys = df_AEM['northing '].values
+    for filename in glob.glob(os.path.join(pmap_dir, "*.mat")):
+        # Get the fid
+        fid = float('.'.join([filename.split('.')[3],
+                              filename.split('.')[4]]))
+        seq = int(filename.split('.')[1])
+        records.append((np.round(fid, 1), seq, filename))
 
-df_AEM['geometry'] = [Point(xs[i],ys[i]) for i in range(len(xs))]
+    df = pd.DataFrame(records, columns = ['fid_key', 'uniqueid_key', 'matfile'])
 
-gdf_AEM = gpd.GeoDataFrame(df_AEM)
+    return df.drop_duplicates(['fid_key', 'uniqueid_key'], keep = 'last')
 
-# Keep only 1D columns
+def map_pmap_files(df_AEM, pmap_files):
+    """Join the pmap file names onto the rjmcmc points.
 
-cols = [x for x in df_AEM.columns if not '[' in x]
+    Parameters
+    ----------
+    df_AEM : dataframe
+        Dataframe of rjmcmc points with 'fiducial ' and 'uniqueid ' columns
+    pmap_files : dataframe
+        Dataframe from get_pmap_files
 
-gdf_AEM = gdf_AEM[cols]
+    Returns
+    -------
+    array
+        Pmap file name for each point, or '' where there is no file
 
-# Now we want to get a link to the pmap files
+    """
+    keys = pd.DataFrame({'fid_key': np.round(df_AEM['fiducial '].values.astype(float), 1),
+                         'uniqueid_key': df_AEM['uniqueid '].values.astype(int)})
 
-gdf_AEM['matfile'] = ''
+    matched = keys.merge(pmap_files, how = 'left', on = ['fid_key', 'uniqueid_key'])
 
-# iterate through the geodataframe and find the files
-# based on the naming convention
+    return matched['matfile'].fillna('').values
 
-pmap_files = {}
+def main(infile, pmap_dir):
+    #load file as pandas dataframe using .dfn file
+    dat = aseg_gdf2.read(infile)
 
-for filename in glob.glob(os.path.join(pmap_dir, "*.mat")):
-    # Get the fid
-    fid = np.float('.'.join([filename.split('.')[3],
-                            filename.split('.')[4]]))
-    seq = np.int(filename.split('.')[1])
-    pmap_files[(fid, seq)] = filename
+    df_AEM = dat.df()
 
-# Iterate through the geodataframe
-for index, row in gdf_AEM.iterrows():
-    fid = np.float(row['fiducial '])
-    seq = np.int(row['uniqueid '])
-    # Use this fid to find the pmap file from the directory
-    for item in pmap_files.keys():
-        if np.round(item[0],1) == np.round(fid,1):
-            if seq == item[1]:
-                gdf_AEM.at[index, 'matfile'] = pmap_files[item]
-                continue
-    
-        
-# Export the file
+    geometry = gpd.points_from_xy(df_AEM['easting '].values, df_AEM['northing '].values)
 
-gdf_AEM.to_csv(infile + '_map.csv', index = False)
+    # Keep only 1D columns
+    cols = [x for x in df_AEM.columns if not '[' in x]
 
-# Now create a shapefile
+    gdf_AEM = gpd.GeoDataFrame(df_AEM[cols], geometry = geometry)
 
-gdf_AEM.crs = {'init' :'epsg:28352'}
+    # Now we want to get a link to the pmap files based on the naming convention
+    gdf_AEM['matfile'] = map_pmap_files(gdf_AEM, get_pmap_files(pmap_dir))
 
-gdf_AEM.to_file(infile + '.shp')
\ No newline at end of file
+    # Export the file
+    gdf_AEM.to_csv(infile + '_map.csv', index = False)
+
+    # Now create a shapefile
+    gdf_AEM.crs = {'init' :'epsg:28352'}
+
+    gdf_AEM.to_file(infile + '.shp')
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2])
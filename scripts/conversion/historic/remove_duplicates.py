@@ -1,40 +1,112 @@
 # A script for removing duplicate points from the aseg-gdf directory
 # We keep the row with the lowest misift
+#
+# usage: python remove_duplicates.py infile.dat [outfile.dat]
+#
+# If no outfile is given the infile is replaced.
 
-import geopandas as gpd
 import numpy as np
-import pandas as pd
 import aseg_gdf2
-from shapely.geometry import Point
 import sys
-import glob
 import os
 
-#load file as pandas dataframe using .dfn file
+def find_rows_to_keep(fiducials, misfits):
+    """Find the row with the lowest misfit for each fiducial.
 
-infile = sys.argv[1]
+    Parameters
+    ----------
+    fiducials : array
+        Fiducial of each row.
+    misfits : array
+        Misfit of each row.
 
-dat = aseg_gdf2.read(infile)
+    Returns
+    -------
+    array
+        Ascending array of the indices of the rows to keep. Where rows for a
+        fiducial have the same lowest misfit the first of them is kept
 
-df_AEM = dat.df()
+    """
+    fiducials = np.asarray(fiducials)
+    misfits = np.asarray(misfits)
 
-outfile = infile.replace('.dat', '_fixed.dat')
+    # Sort by fiducial, then misfit, then row so the first row for each
+    # fiducial is the one we keep
+    order = np.lexsort((np.arange(len(fiducials)), misfits, fiducials))
+    sorted_fids = fiducials[order]
 
-with open(infile, 'r') as inf:
-    with open(outfile, 'w') as outf:
-        for i, line in enumerate(inf):
-            fid = df_AEM.iloc[i]['fiducial ']
-            # use mask to find duplicate entries
-            df_fid = df_AEM[df_AEM['fiducial '] == fid]
-            if len(df_fid) == 1:
-                outf.write(line)
-            elif df_fid['misfit_lowest '].min() == df_AEM.iloc[i]['misfit_lowest ']:
-                outf.write(line)
-                print(i)
-            else:
-                pass
+    first = np.ones(len(order), dtype = bool)
+    first[1:] = sorted_fids[1:] != sorted_fids[:-1]
 
-# Now delete the old .dat file and rename the new
+    return np.sort(order[first])
 
-os.remove(infile)
-os.rename(outfile, infile)
+def write_rows(infile, outfile, rows):
+    """Stream the lines of infile with the given indices to outfile.
+
+    Parameters
+    ----------
+    infile : string
+        Path to the input file.
+    outfile : string
+        Path to the output file.
+    rows : array
+        Ascending array of line indices to write.
+
+    """
+    rows = iter(rows)
+    next_row = next(rows, None)
+
+    with open(infile, 'r') as inf:
+        with open(outfile, 'w') as outf:
+            for i, line in enumerate(inf):
+                if next_row is None:
+                    break
+                if i == next_row:
+                    outf.write(line)
+                    next_row = next(rows, None)
+
+def remove_duplicates(infile, outfile = None, fiducial_column = 'fiducial ',
+                      misfit_column = 'misfit_lowest '):
+    """Remove duplicate fiducials from an aseg-gdf .dat file, keeping the row
+    with the lowest misfit.
+
+    Parameters
+    ----------
+    infile : string
+        Path to the .dat file. The .dfn file must be in the same directory
+    outfile : string
+        Path for the deduplicated .dat file. If None the infile is replaced
+    fiducial_column : string
+        Name of the fiducial column in the .dfn file
+    misfit_column : string
+        Name of the misfit column in the .dfn file
+
+    Returns
+    -------
+    integer
+        Number of rows removed
+
+    """
+    #load file as pandas dataframe using .dfn file
+    df_AEM = aseg_gdf2.read(infile).df()
+
+    rows = find_rows_to_keep(df_AEM[fiducial_column].values,
+                             df_AEM[misfit_column].values)
+
+    replace = outfile is None
+    if replace:
+        outfile = infile.replace('.dat', '_fixed.dat')
+
+    write_rows(infile, outfile, rows)
+
+    # Now replace the old .dat file with the new
+    if replace:
+        os.replace(outfile, infile)
+
+    return len(df_AEM) - len(rows)
+
+if __name__ == '__main__':
+    infile = sys.argv[1]
+    outfile = sys.argv[2] if len(sys.argv) > 2 else None
+    n_removed = remove_duplicates(infile, outfile)
+    print("Removed {} duplicate rows".format(n_removed))
@@ -15,10 +15,15 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 #===============================
-from collections import Sequence
+from collections import Sequence, Mapping
 import h5py
 import numpy as np
 
+# Variables that are always loaded with gridded sections
+section_coordinate_variables = ['easting', 'northing', 'grid_elevations',
+                                'depth_of_investigation', 'elevation',
+                                'grid_distances']
+
 def check_list_arg(object):
     """Function for checking if
 
@@ -45,13 +50,122 @@ def dict_to_hdf5(fname, dictionary):
         dset = f.create_dataset(key, data=dictionary[key])
     f.close()
 
+def get_compression_kwargs(compression = None, compression_opts = None):
+    """Get the keyword arguments for creating compressed hdf5 datasets.
+
+    Parameters
+    ----------
+    compression : string
+        One of None, 'gzip', 'lzf' or 'blosc'. Blosc requires the hdf5plugin
+        package.
+    compression_opts : object
+        Compression options passed to h5py, e.g. the gzip level.
+
+    Returns
+    -------
+    dictionary
+        Keyword arguments for h5py create_dataset
+
+    """
+    if compression is None:
+        return {}
+    if compression == 'blosc':
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("Blosc compression requires the hdf5plugin package")
+        if compression_opts is None:
+            return dict(hdf5plugin.Blosc())
+        return dict(hdf5plugin.Blosc(**compression_opts))
+    if compression in ['gzip', 'lzf']:
+        return {'compression': compression, 'compression_opts': compression_opts,
+                'shuffle': True}
+    raise ValueError("compression must be one of None, 'gzip', 'lzf' or 'blosc'")
+
+def dict_to_section_store(fname, line, dictionary, chunk_width = 256,
+                          compression = None, compression_opts = None,
+                          dtype = None):
+    """
+    Save a gridded section to a group in a hdf5 section store. The section
+    store keeps all lines in a single file with one group per line. Datasets
+    are chunked in windows along the line so that a subset of a section can be
+    read without loading the whole array.
+
+    Parameters
+    ----------
+    fname : string
+        Path to the section store. The file is created if it does not exist.
+    line : integer
+        AEM line number.
+    dictionary : dictionary
+        Gridded variables for the line.
+    chunk_width : integer
+        Number of grid distances in each chunk.
+    compression : string
+        One of None, 'gzip', 'lzf' or 'blosc'.
+    compression_opts : object
+        Compression options passed to h5py, e.g. the gzip level.
+    dtype : numpy datatype
+        If not None, 2D floating point variables are downcast to this type
+        (e.g. np.float32). 1D variables such as coordinates and fiducials are
+        kept at full precision.
+
+    """
+    compression_kwargs = get_compression_kwargs(compression, compression_opts)
+
+    with h5py.File(fname, "a") as f:
+        group_name = str(int(line))
+        # Overwrite the line if it has already been saved
+        if group_name in f:
+            del f[group_name]
+        group = f.create_group(group_name)
+        for key in dictionary.keys():
+            arr = np.asarray(dictionary[key])
+            if dtype is not None and arr.ndim > 1 and arr.dtype.kind == 'f':
+                arr = arr.astype(dtype)
+            # Scalars and empty arrays cannot be chunked
+            if arr.ndim == 0 or arr.size == 0:
+                group.create_dataset(key, data=arr)
+                continue
+            # Grid distances are along the last axis
+            chunks = arr.shape[:-1] + (min(chunk_width, arr.shape[-1]),)
+            group.create_dataset(key, data=arr, chunks=chunks, **compression_kwargs)
+
+def extract_section_store_data(fname, grid_vars, lines = None):
+    """Load gridded sections from a hdf5 section store.
+
+    Parameters
+    ----------
+    fname : string
+        Path to the section store.
+    grid_vars : list
+        A list of variables to load.
+    lines : list
+        A list of lines to load. If None all lines are loaded.
+
+    Returns
+    -------
+    dictionary
+        Dictionary of gridded variables with the line number as the key
+
+    """
+    sections = {}
+
+    with h5py.File(fname, "r") as f:
+        if lines is None:
+            lines = sorted([int(x) for x in f.keys()])
+        for line in lines:
+            sections[line] = extract_hdf5_data(f[str(int(line))], grid_vars)
+
+    return sections
+
 def extract_hdf5_data(file, grid_vars):
     """Short summary.
 
     Parameters
     ----------
     file : type
-        Description of parameter `file`.
+        An open h5py file or the group for a line in a section store.
     grid_vars : type
         Description of parameter `grid_vars`.
 
@@ -65,24 +179,148 @@ def extract_hdf5_data(file, grid_vars):
     datasets = {}
 
     for item in file.values():
-        if item.name[1:] in grid_vars:
-            datasets[item.name[1:]] = item[()]
+        # Name relative to the file or group
+        name = item.name.split('/')[-1]
+        if name in grid_vars:
+            datasets[name] = item[()]
         # We also need to know easting, northing, doi, elevations and grid elevations
-        if item.name[1:] == 'easting':
+        if name == 'easting':
             datasets['easting'] = item[()]
-        if item.name[1:] == 'northing':
+        if name == 'northing':
             datasets['northing'] = item[()]
-        if item.name[1:] == 'grid_elevations':
+        if name == 'grid_elevations':
             datasets['grid_elevations'] = item[()]
-        if item.name[1:] == 'depth_of_investigation':
+        if name == 'depth_of_investigation':
             datasets['depth_of_investigation'] = item[()]
-        if item.name[1:] == 'elevation':
+        if name == 'elevation':
             datasets['elevation'] = item[()]
-        if item.name[1:] == 'grid_distances':
+        if name == 'grid_distances':
             datasets['grid_distances'] = item[()]
 
     return datasets
 
+class LazySection(Mapping):
+    """
+    Read-only dictionary of gridded section variables that is backed by a
+    hdf5 file. Variables are only read from file the first time they are
+    accessed, optionally within a window of distances along the line.
+    """
+
+    def __init__(self, fname, grid_vars, group_name = '/', window = None):
+        """Initialise the lazy section.
+
+        Parameters
+        ----------
+        fname : string
+            Path to the hdf5 file or section store.
+        grid_vars : list
+            A list of variables to load from the hdf5 file
+        group_name : string
+            Group with the line variables. This is '/' for hdf5 files with a
+            single line and the line number for section stores.
+        window : tuple
+            If not None a (minimum, maximum) tuple of grid distances. Only the
+            part of the section within this window is read.
+
+        """
+        self.fname = fname
+        self.group_name = group_name
+        self.grid_vars = grid_vars
+        self.window = window
+        self._keys = None
+        self._columns = None
+        self._ncolumns = None
+        self._arrays = {}
+
+    def _load_metadata(self):
+        """Get the variable names and the along-line window from the file. Only
+        grid_distances is read and only if a window is defined.
+        """
+        with h5py.File(self.fname, 'r') as f:
+            group = f[self.group_name]
+            self._keys = [key for key in group.keys() if key in self.grid_vars
+                          or key in section_coordinate_variables]
+            if 'grid_distances' in group:
+                self._ncolumns = group['grid_distances'].shape[0]
+                if self.window is not None:
+                    self._columns = self._window_columns(group['grid_distances'][()],
+                                                         self.window)
+
+    @staticmethod
+    def _window_columns(grid_distances, window):
+        """Get the slice of grid distances within a window."""
+        start = np.searchsorted(grid_distances, window[0], side = 'left')
+        stop = np.searchsorted(grid_distances, window[1], side = 'right')
+        return slice(start, stop)
+
+    def _read(self, dset, columns = None):
+        """Read a dataset, slicing along the line if the dataset varies along
+        the line and columns is defined.
+        """
+        along_line = (dset.ndim > 0 and dset.shape[-1] == self._ncolumns and
+                      dset.name.split('/')[-1] != 'grid_elevations')
+        if columns is not None and along_line:
+            return dset[..., columns]
+        return dset[()]
+
+    def keys(self):
+        if self._keys is None:
+            self._load_metadata()
+        return list(self._keys)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, key):
+        if key not in self._arrays:
+            if key not in self.keys():
+                raise KeyError(key)
+            with h5py.File(self.fname, 'r') as f:
+                self._arrays[key] = self._read(f[self.group_name][key], self._columns)
+        return self._arrays[key]
+
+    def get_window(self, centre, buffer, variables = None):
+        """Read the section within a buffer of a distance along the line.
+        Windowed arrays are not cached.
+
+        Parameters
+        ----------
+        centre : float
+            Distance along the line.
+        buffer : float
+            Distance either side of the centre.
+        variables : list
+            Variables to read. If None all variables are read.
+
+        Returns
+        -------
+        dictionary
+            Dictionary of windowed gridded variables
+
+        """
+        if variables is None:
+            variables = self.keys()
+        else:
+            variables = [v for v in self.keys() if v in variables or
+                         v in section_coordinate_variables]
+
+        with h5py.File(self.fname, 'r') as f:
+            group = f[self.group_name]
+            grid_distances = self['grid_distances']
+            columns = self._window_columns(grid_distances, (centre - buffer,
+                                                            centre + buffer))
+            # Offset the columns if this section is already windowed
+            if self._columns is not None:
+                columns = slice(self._columns.start + columns.start,
+                                self._columns.start + columns.stop)
+            return {v: self._read(group[v], columns) for v in variables}
+
 def return_floats(string):
     try:
         return [float(x) for x in string.split()]
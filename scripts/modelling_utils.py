@@ -25,12 +25,461 @@ Code for creating geological modelled objects
 '''
 import os
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import Matern
 from shapely.geometry import Point, MultiPoint, Polygon
 import geopandas as gpd
+import spatial_functions
+
+class LocalGaussianProcess:
+    """
+    Gaussian process regressor that predicts using only the nearest
+    interpreted points.
+
+    The kernel hyperparameters are optimised once on a random subset of the
+    training points. Prediction points are then grouped into square tiles and a
+    small Gaussian process with the fitted kernel is solved for each tile using
+    the training points nearest to the tile centre. This scales to many
+    thousands of points where the dense GaussianProcessRegressor, which is
+    O(n^3), does not.
+
+    The fit/predict interface follows sklearn's GaussianProcessRegressor.
+    """
+    def __init__(self, kernel = Matern(length_scale=5000, nu = 1.5), n_neighbours = 200,
+                 n_subset = 1000, tile_size = None, n_restarts_optimizer = 5,
+                 normalize_y = True, alpha = 1e-10, random_state = 0):
+        """Initialise instance of local gaussian process.
+
+        Parameters
+        ----------
+        kernel : sklearn kernel
+            Kernel for the gaussian process.
+        n_neighbours : integer
+            Number of nearest training points used to predict each tile.
+        n_subset : integer
+            Maximum number of training points used for optimising the kernel
+            hyperparameters.
+        tile_size : float
+            Width of the square tiles that prediction points are grouped into.
+            If None a size is chosen from the density of the training points.
+        n_restarts_optimizer : integer
+            Number of optimizer restarts when fitting the hyperparameters.
+        normalize_y : boolean
+            If True the target values are normalised by their mean and
+            standard deviation.
+        alpha : float
+            Value added to the diagonal of the kernel matrix.
+        random_state : integer
+            Seed for the subset selection and optimizer restarts.
+
+        """
+        self.kernel = kernel
+        self.n_neighbours = n_neighbours
+        self.n_subset = n_subset
+        self.tile_size = tile_size
+        self.n_restarts_optimizer = n_restarts_optimizer
+        self.normalize_y = normalize_y
+        self.alpha = alpha
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        """Fit the kernel hyperparameters and index the training points.
+
+        Parameters
+        ----------
+        X : ndarray of shape (n_samples, 2)
+            Training point coordinates.
+        y : array of shape (n_samples)
+            Training values.
+
+        Returns
+        -------
+        self
+
+        """
+        X = np.asarray(X, dtype = np.float64)
+        y = np.asarray(y, dtype = np.float64)
+
+        # Fit the hyperparameters on a random subset of the points
+        rng = np.random.RandomState(self.random_state)
+        if X.shape[0] > self.n_subset:
+            subset = np.sort(rng.choice(X.shape[0], self.n_subset, replace = False))
+        else:
+            subset = np.arange(X.shape[0])
+
+        gp = GaussianProcessRegressor(kernel = self.kernel,
+                                      n_restarts_optimizer = self.n_restarts_optimizer,
+                                      normalize_y = self.normalize_y,
+                                      alpha = self.alpha,
+                                      random_state = self.random_state)
+        gp.fit(X[subset], y[subset])
+
+        self.kernel_ = gp.kernel_
+
+        if self.normalize_y:
+            self._y_train_mean = np.mean(y)
+            self._y_train_std = np.std(y) if np.std(y) > 0. else 1.
+        else:
+            self._y_train_mean = 0.
+            self._y_train_std = 1.
+
+        self.X_train_ = X
+        self.y_train_ = (y - self._y_train_mean) / self._y_train_std
+
+        self.spatial_index = spatial_functions.SpatialIndex(X)
+
+        return self
+
+    def _get_tile_size(self):
+        if self.tile_size is not None:
+            return self.tile_size
+        # Choose tiles that each cover the area of about a tenth of the neighbourhood
+        extent = np.ptp(self.X_train_, axis = 0)
+        area = max(np.prod(extent), np.max(extent)**2 / self.X_train_.shape[0], 1.)
+        return np.sqrt(area * self.n_neighbours / (10. * self.X_train_.shape[0]))
+
+    def predict(self, X, return_std = False):
+        """Predict using the local gaussian process.
+
+        Parameters
+        ----------
+        X : ndarray of shape (n_samples, 2)
+            Coordinates of prediction points.
+        return_std : boolean
+            If True the standard deviation of the prediction is also returned.
+
+        Returns
+        -------
+        y_mean
+            Array of predictions
+        y_std
+            Array of standard deviations. Only returned if return_std is True
+
+        """
+        X = np.asarray(X, dtype = np.float64)
+
+        y_mean = np.zeros(X.shape[0], dtype = np.float64)
+        y_std = np.zeros(X.shape[0], dtype = np.float64)
+
+        k = min(self.n_neighbours, self.X_train_.shape[0])
+
+        # Group the prediction points into tiles
+        tile_size = self._get_tile_size()
+        tile_ij = np.floor((X - np.min(X, axis = 0)) / tile_size).astype(np.int64)
+        _, tile_inds = np.unique(tile_ij, axis = 0, return_inverse = True)
+        tile_inds = tile_inds.ravel()
+
+        order = np.argsort(tile_inds, kind = 'stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(tile_inds))))
+
+        for i in range(len(offsets) - 1):
+            inds = order[offsets[i]:offsets[i+1]]
+            Xp = X[inds]
+
+            # Use the training points nearest to the tile centre
+            centre = 0.5 * (np.min(Xp, axis = 0) + np.max(Xp, axis = 0))
+            _, neighbours = self.spatial_index.kdtree.query(centre, k = k)
+            neighbours = np.atleast_1d(neighbours)
+
+            Xn = self.X_train_[neighbours]
+
+            K = self.kernel_(Xn)
+            K[np.diag_indices_from(K)] += self.alpha
+            L = cho_factor(K, lower = True)
+
+            K_trans = self.kernel_(Xp, Xn)
+            y_mean[inds] = K_trans.dot(cho_solve(L, self.y_train_[neighbours]))
+
+            if return_std:
+                v = solve_triangular(L[0], K_trans.T, lower = True)
+                y_var = self.kernel_.diag(Xp) - np.einsum('ij,ij->j', v, v)
+                y_std[inds] = np.sqrt(np.clip(y_var, 0., None))
+
+        y_mean = y_mean * self._y_train_std + self._y_train_mean
+
+        if return_std:
+            return y_mean, y_std * self._y_train_std
+        return y_mean
+
+def cholesky_update(L, x):
+    """Rank-one update of a lower triangular Cholesky factor so that the new
+    factor L' satisfies L'L'^T = LL^T + xx^T.
+
+    Parameters
+    ----------
+    L : ndarray of shape (n, n)
+        Lower triangular Cholesky factor. This is modified in place
+    x : array of shape (n)
+        Update vector
+
+    Returns
+    -------
+    ndarray
+        Updated Cholesky factor
+
+    """
+    x = np.array(x, dtype = np.float64)
+    for k in range(x.shape[0]):
+        r = np.hypot(L[k,k], x[k])
+        c = r / L[k,k]
+        s = x[k] / L[k,k]
+        L[k,k] = r
+        L[k+1:,k] = (L[k+1:,k] + s * x[k+1:]) / c
+        x[k+1:] = c * x[k+1:] - s * L[k+1:,k]
+    return L
+
+class IncrementalGaussianProcess:
+    """
+    Gaussian process regressor that can add and remove training points
+    without refitting.
+
+    The kernel hyperparameters are optimised when the process is fitted. Points
+    that are added or removed afterwards update the Cholesky factor of the
+    kernel matrix with rank-one operations, which is O(n^2) rather than the
+    O(n^3) of a full fit. The hyperparameters are only re-optimised when
+    fit is called or after every refit_every edits.
+
+    The fit/predict interface follows sklearn's GaussianProcessRegressor.
+    """
+    def __init__(self, kernel = Matern(length_scale=5000, nu = 1.5), refit_every = None,
+                 n_restarts_optimizer = 5, normalize_y = True, alpha = 1e-10,
+                 random_state = None):
+        """Initialise instance of incremental gaussian process.
+
+        Parameters
+        ----------
+        kernel : sklearn kernel
+            Kernel for the gaussian process.
+        refit_every : integer
+            Number of added or removed points after which the hyperparameters
+            are re-optimised. If None they are only optimised by fit.
+        n_restarts_optimizer : integer
+            Number of optimizer restarts when fitting the hyperparameters.
+        normalize_y : boolean
+            If True the target values are normalised by the mean and standard
+            deviation of the values at the last fit.
+        alpha : float
+            Value added to the diagonal of the kernel matrix.
+        random_state : integer
+            Seed for the optimizer restarts.
+
+        """
+        self.kernel = kernel
+        self.refit_every = refit_every
+        self.n_restarts_optimizer = n_restarts_optimizer
+        self.normalize_y = normalize_y
+        self.alpha = alpha
+        self.random_state = random_state
+
+    @property
+    def is_fitted(self):
+        return hasattr(self, 'L_')
+
+    def fit(self, X, y, keys = None):
+        """Optimise the kernel hyperparameters and factorise the kernel matrix.
+
+        Parameters
+        ----------
+        X : ndarray of shape (n_samples, 2)
+            Training point coordinates.
+        y : array of shape (n_samples)
+            Training values.
+        keys : array of shape (n_samples)
+            Unique key for each point, used by update to find which points
+            have changed. Defaults to the row number.
+
+        Returns
+        -------
+        self
+
+        """
+        X = np.asarray(X, dtype = np.float64)
+        y = np.asarray(y, dtype = np.float64)
+
+        gp = GaussianProcessRegressor(kernel = self.kernel,
+                                      n_restarts_optimizer = self.n_restarts_optimizer,
+                                      normalize_y = self.normalize_y,
+                                      alpha = self.alpha,
+                                      random_state = self.random_state)
+        gp.fit(X, y)
+
+        self.kernel_ = gp.kernel_
+
+        if self.normalize_y:
+            self._y_train_mean = np.mean(y)
+            self._y_train_std = np.std(y) if np.std(y) > 0. else 1.
+        else:
+            self._y_train_mean = 0.
+            self._y_train_std = 1.
+
+        self.X_train_ = X
+        self.y_train_ = y
+        self.keys_ = np.arange(X.shape[0]) if keys is None else np.asarray(keys)
+
+        K = self.kernel_(X)
+        K[np.diag_indices_from(K)] += self.alpha
+        self.L_ = np.linalg.cholesky(K)
+        self._solve()
+
+        self.n_edits_ = 0
+
+        return self
+
+    def _solve(self):
+        y = (self.y_train_ - self._y_train_mean) / self._y_train_std
+        self.alpha_ = cho_solve((self.L_, True), y)
+
+    def add_points(self, X, y, keys = None):
+        """Add training points by appending rows to the Cholesky factor.
+
+        Parameters
+        ----------
+        X : ndarray of shape (n_samples, 2)
+            New point coordinates.
+        y : array of shape (n_samples)
+            New values.
+        keys : array of shape (n_samples)
+            Unique key for each new point.
+
+        """
+        X = np.asarray(X, dtype = np.float64).reshape((-1, 2))
+        y = np.asarray(y, dtype = np.float64).ravel()
+        if keys is None:
+            keys = np.arange(X.shape[0]) + (np.max(self.keys_) + 1 if len(self.keys_) > 0 else 0)
+
+        for i in range(X.shape[0]):
+            n = self.X_train_.shape[0]
+            x = X[i:i+1]
+            k = self.kernel_(self.X_train_, x).ravel()
+            c = self.kernel_.diag(x)[0] + self.alpha
+            l = solve_triangular(self.L_, k, lower = True)
+            L = np.zeros((n + 1, n + 1), dtype = np.float64)
+            L[:n,:n] = self.L_
+            L[n,:n] = l
+            L[n,n] = np.sqrt(max(c - l.dot(l), self.alpha))
+            self.L_ = L
+            self.X_train_ = np.vstack((self.X_train_, x))
+
+        self.y_train_ = np.concatenate((self.y_train_, y))
+        self.keys_ = np.concatenate((self.keys_, keys))
+        self.n_edits_ += X.shape[0]
+        self._solve()
+
+    def remove_points(self, indices):
+        """Remove training points by deleting their rows from the Cholesky
+        factor and updating the trailing block.
+
+        Parameters
+        ----------
+        indices : array
+            Indices of the training points to remove.
+
+        """
+        # Remove from the end so the remaining indices stay valid
+        for idx in np.sort(np.asarray(indices, dtype = np.int64))[::-1]:
+            L = self.L_
+            L33 = L[idx+1:, idx+1:].copy()
+            if L33.shape[0] > 0:
+                L33 = cholesky_update(L33, L[idx+1:, idx])
+            L = np.delete(np.delete(L, idx, axis = 0), idx, axis = 1)
+            L[idx:, idx:] = L33
+            self.L_ = L
+
+        self.X_train_ = np.delete(self.X_train_, indices, axis = 0)
+        self.y_train_ = np.delete(self.y_train_, indices)
+        self.keys_ = np.delete(self.keys_, indices)
+        self.n_edits_ += len(indices)
+        self._solve()
+
+    def update(self, X, y, keys):
+        """Update the process to a new set of training points. Points whose keys
+        are new or whose coordinates or values have changed are added, and
+        points whose keys are gone are removed. The hyperparameters are
+        re-optimised if the process is not fitted or refit_every edits have
+        been made.
+
+        Parameters
+        ----------
+        X : ndarray of shape (n_samples, 2)
+            Training point coordinates.
+        y : array of shape (n_samples)
+            Training values.
+        keys : array of shape (n_samples)
+            Unique key for each point.
+
+        Returns
+        -------
+        self
+
+        """
+        X = np.asarray(X, dtype = np.float64)
+        y = np.asarray(y, dtype = np.float64)
+        keys = np.asarray(keys)
+
+        if not self.is_fitted:
+            return self.fit(X, y, keys)
+
+        # Find the points that are unchanged
+        new_positions = {key: i for i, key in enumerate(keys)}
+        unchanged = np.zeros(len(self.keys_), dtype = bool)
+        added = np.ones(len(keys), dtype = bool)
+
+        for i, key in enumerate(self.keys_):
+            j = new_positions.get(key)
+            if j is not None and np.all(X[j] == self.X_train_[i]) and y[j] == self.y_train_[i]:
+                unchanged[i] = True
+                added[j] = False
+
+        n_edits = np.sum(~unchanged) + np.sum(added)
+
+        if n_edits == 0:
+            return self
+
+        if self.refit_every is not None and self.n_edits_ + n_edits >= self.refit_every:
+            return self.fit(X, y, keys)
+
+        if np.any(~unchanged):
+            self.remove_points(np.where(~unchanged)[0])
+        if np.any(added):
+            self.add_points(X[added], y[added], keys[added])
+
+        return self
+
+    def predict(self, X, return_std = False):
+        """Predict using the gaussian process.
+
+        Parameters
+        ----------
+        X : ndarray of shape (n_samples, 2)
+            Coordinates of prediction points.
+        return_std : boolean
+            If True the standard deviation of the prediction is also returned.
+
+        Returns
+        -------
+        y_mean
+            Array of predictions
+        y_std
+            Array of standard deviations. Only returned if return_std is True
+
+        """
+        X = np.asarray(X, dtype = np.float64)
+
+        K_trans = self.kernel_(X, self.X_train_)
+        y_mean = K_trans.dot(self.alpha_) * self._y_train_std + self._y_train_mean
+
+        if not return_std:
+            return y_mean
+
+        v = solve_triangular(self.L_, K_trans.T, lower = True)
+        y_var = self.kernel_.diag(X) - np.einsum('ij,ij->j', v, v)
+        y_std = np.sqrt(np.clip(y_var, 0., None)) * self._y_train_std
+
+        return y_mean, y_std
 
 class modelled_boundary:
     """
@@ -69,6 +518,9 @@ class modelled_boundary:
                                              self.name + "_interpreted_points.csv")
         # Create an instance variable of grid coordinates
         self.grid_coords = None
+        # The grid mask is cached against the polygon it was computed from
+        self._grid_mask = None
+        self._grid_mask_polygon = None
 
     def get_convex_hull(self, convex_hull_buffer = 1000.):
         """
@@ -115,7 +567,8 @@ class modelled_boundary:
         self.interpreted_points = df
 
 
-    def create_interpolator(self, kernel = Matern(length_scale=5000, nu = 1.5), name = 'interpolator_1'):
+    def create_interpolator(self, kernel = Matern(length_scale=5000, nu = 1.5), name = 'interpolator_1',
+                            backend = 'dense', **kwargs):
         """Create an Gaussian interpolator for on the fly gridding.
 
         Parameters
@@ -123,6 +576,14 @@ class modelled_boundary:
         length_scale : float
             Length scale for interpolation.  This is very dependent on the data
             desnity and the smoothness of the boudnary
+        backend : string
+            'dense' for an sklearn GaussianProcessRegressor, 'local' for a
+            LocalGaussianProcess, which scales to thousands of points, or
+            'incremental' for an IncrementalGaussianProcess, which is updated
+            rather than refitted when points are added or removed
+        **kwargs
+            Keyword arguments passed to LocalGaussianProcess or
+            IncrementalGaussianProcess
 
         Returns
         -------
@@ -135,9 +596,16 @@ class modelled_boundary:
             print('That interpolator name is in use. Please use another.')
             raise ValueError()
 
-        setattr(self, name, GaussianProcessRegressor(kernel=kernel,
-                                                     n_restarts_optimizer=5,
-                                                     normalize_y=True))
+        if backend == 'dense':
+            setattr(self, name, GaussianProcessRegressor(kernel=kernel,
+                                                         n_restarts_optimizer=5,
+                                                         normalize_y=True))
+        elif backend == 'local':
+            setattr(self, name, LocalGaussianProcess(kernel=kernel, **kwargs))
+        elif backend == 'incremental':
+            setattr(self, name, IncrementalGaussianProcess(kernel=kernel, **kwargs))
+        else:
+            raise ValueError("backend must be 'dense', 'local' or 'incremental'")
 
     def create_grid(self, xmin, xmax, ymin, ymax, cell_size = 500., convex_hull = False,convex_hull_buffer = 1000.):
 
@@ -167,16 +635,21 @@ class modelled_boundary:
         self.width = x__.shape[1]
         self.height = x__.shape[0]
         self.grid_coords = np.column_stack((x__.ravel(), y__.ravel()))
+        self._grid_mask = None
 
         # Create a convex hull
         if convex_hull:
             self.convex_hull = self.get_convex_hull(convex_hull_buffer = convex_hull_buffer)
 
-    def fit_interpolator(self, variable, interpolator_name):
+    def fit_interpolator(self, variable, interpolator_name, refit = False):
         """Fit the gaussian process to generate a function for prediction.
 
         Parameters
         ----------
+        refit : boolean
+            Only used by incremental interpolators. If True the hyperparameters
+            are re-optimised, otherwise the interpolator is updated with the
+            points that have been added or removed since it was last fitted.
         """
         assert variable in self.interpreted_points.keys()
 
@@ -193,7 +666,13 @@ class modelled_boundary:
         y = self.interpreted_points[variable]
 
         gp = getattr(self,interpolator_name)
-        gp.fit(X,y)
+
+        if isinstance(gp, IncrementalGaussianProcess) and not refit:
+            gp.update(X, y, self.interpreted_points.index.values)
+        elif isinstance(gp, IncrementalGaussianProcess):
+            gp.fit(X, y, self.interpreted_points.index.values)
+        else:
+            gp.fit(X,y)
 
     def predict_at_points(self, coordinates, interpolator_name, return_std = True):
         """A function for predicting the from our Gaussian process.
@@ -211,11 +690,19 @@ class modelled_boundary:
         gp = getattr(self,interpolator_name)
         return gp.predict(coordinates, return_std = return_std)
 
-    def predict_on_grid(self, interpolator_name, grid_name, return_std = True):
+    def predict_on_grid(self, interpolator_name, grid_name, return_std = True,
+                        tile_size = 64, n_workers = 1):
         """A function for predicting onto every point on our grid.
 
-        convex_hull_buffer: float
-            The buffer around the convex hull for masking our interpolated surface
+        The grid is predicted in square tiles so that the cross-covariance
+        between the prediction and training points, and hence peak memory, is
+        bounded by the tile size. Tiles entirely outside of the extent or
+        convex hull are skipped.
+
+        tile_size: integer
+            Number of grid cells along each side of a tile
+        n_workers: integer
+            Number of threads used to predict tiles
 
         Returns
         -------
@@ -223,53 +710,132 @@ class modelled_boundary:
             2D gridded array
 
         """
-        spatial_mask = False
         # first check the interpolator exists
         if not hasattr(self, interpolator_name):
             print('That interpolator does not exist. Please create one or check the interpolator_name keyword argument.')
             raise ValueError()
 
         # Check grid coordinates are defined
-        if not self.grid_coords is None:
-            if return_std:
-                grid, grid_std = self.predict_at_points(self.grid_coords, interpolator_name)
-            else:
-                grid = self.predict_at_points(self.grid_coords, interpolator_name, return_std = False)
-
-            # If a convex hull exists then we will use it to create a mask for
-            # our inteprolated grid
-            if hasattr(self, 'extent'):
-                poly = self.extent
-                spatial_mask = True
-            elif hasattr(self, 'convex_hull'):
-                poly = self.convex_hull
-                spatial_mask = True
-            if spatial_mask:
-                mask = np.array([Point(x).within(poly) for x in self.grid_coords])
-                # Assign all values outside of the convex hull nan
-                grid = grid.flatten()
-                grid[~mask] = np.nan
-                # reshape for easy plotting
-                grid = grid.reshape((self.height,self.width)).T
-
-                ## TODO add flag
-                if return_std:
-                    grid_std = grid_std.flatten()
-                    grid_std[~mask] = np.nan
-                    # reshape for easy plotting
+        if self.grid_coords is None:
+            raise ValueError("Define grid coordinates")
+
+        # The grid coordinates are ordered with shape (height, width)
+        coords = self.grid_coords.reshape((self.height, self.width, 2))
+
+        # If a convex hull exists then we will use it to create a mask for
+        # our inteprolated grid. Values outside the mask are nan
+        mask = self.get_grid_mask()
+        if mask is not None:
+            mask = mask.reshape((self.height, self.width))
+
+        # Preallocate the output arrays
+        grid = np.full((self.height, self.width), np.nan)
+        grid_std = np.full((self.height, self.width), np.nan) if return_std else None
+
+        tiles = [(slice(i, i + tile_size), slice(j, j + tile_size))
+                 for i in range(0, self.height, tile_size)
+                 for j in range(0, self.width, tile_size)]
+
+        def predict_tile(tile):
+            if mask is None:
+                tile_mask = np.ones(coords[tile].shape[:2], dtype = bool)
             else:
-                pass
-            setattr(self, grid_name, grid.reshape((self.height,self.width)).T)
+                tile_mask = mask[tile]
+                # Skip tiles that are entirely outside of the extent
+                if not np.any(tile_mask):
+                    return
+            pred = self.predict_at_points(coords[tile][tile_mask], interpolator_name,
+                                          return_std = return_std)
+            # Each tile writes to a separate part of the output arrays
             if return_std:
-                setattr(self, grid_name + '_std', grid_std.reshape((self.height,self.width)).T)
+                grid[tile][tile_mask] = pred[0]
+                grid_std[tile][tile_mask] = pred[1]
+            else:
+                grid[tile][tile_mask] = pred
+
+        if n_workers > 1:
+            with ThreadPoolExecutor(max_workers = n_workers) as executor:
+                list(executor.map(predict_tile, tiles))
         else:
-            raise ValueError("Define grid coordinates")
+            for tile in tiles:
+                predict_tile(tile)
+
+        # reshape for easy plotting
+        setattr(self, grid_name, grid.T)
+        if return_std:
+            setattr(self, grid_name + '_std', grid_std.T)
+
+    def get_grid_mask(self):
+        """Get the mask of grid cells within the extent or, if there is no
+        extent, the convex hull. The mask is cached until the grid or polygon
+        changes.
+
+        Returns
+        -------
+        ndarray
+            Boolean array that is True for grid coordinates within the polygon,
+            or None if there is no extent or convex hull
+
+        """
+        if hasattr(self, 'extent'):
+            poly = self.extent
+        elif hasattr(self, 'convex_hull'):
+            poly = self.convex_hull
+        else:
+            return None
+
+        if self._grid_mask is None or self._grid_mask_polygon is not poly:
+            self._grid_mask = spatial_functions.polygon_mask(self.grid_coords, poly)
+            self._grid_mask_polygon = poly
+
+        return self._grid_mask
 
     def load_extent_from_file(self, infile, index = 0):
         """A function for loading the extent geometry from a shapefile.
         """
         self.extent = gpd.read_file(infile)['geometry'].values[index]
+        self._grid_mask = None
+
 
+def batch_full_width_half_max(change_point_pdf, depth_cells, max_idx, fmax):
+    """Vectorised full width at half maximum for many change point pdfs.
+
+    Parameters
+    ----------
+    change_point_pdf : ndarray of shape (n, n_depth)
+        Change point probability for each pick
+    depth_cells : array of shape (n_depth)
+        Depth of each cell
+    max_idx : array of shape (n)
+        Index of the local maximum for each pick
+    fmax : array of shape (n)
+        Change point probability at the local maximum
+
+    Returns
+    -------
+    array
+        Width of the probability interval for each pick. Nan where the
+        probability does not fall to half of the maximum on both sides
+
+    """
+    change_point_pdf = np.atleast_2d(change_point_pdf)
+    max_idx = np.asarray(max_idx).reshape((-1, 1))
+    fmax = np.asarray(fmax).reshape((-1, 1))
+
+    cols = np.arange(change_point_pdf.shape[1])
+
+    below = change_point_pdf <= fmax/2.
+
+    # First cell in the positive direction
+    upper = below & (cols >= max_idx)
+    idx_upper = np.argmax(upper, axis = 1)
+    # Last cell in the negative direction
+    lower = below & (cols <= max_idx)
+    idx_lower = lower.shape[1] - 1 - np.argmax(lower[:, ::-1], axis = 1)
+
+    found = np.any(upper, axis = 1) & np.any(lower, axis = 1)
+
+    return np.where(found, depth_cells[idx_upper] - depth_cells[idx_lower], np.nan)
 
 def full_width_half_max(D, max_idx, fmax):
     """Find the width of the probability interval that is >0.5 times the local
@@ -290,26 +856,19 @@ def full_width_half_max(D, max_idx, fmax):
         Description of returned object.
 
     """
-
-    idx_upper = None
-    idx_lower = None
-
-    # positive direction
-    for idx in np.arange(max_idx, D['depth_cells'].shape[0]):
-        if D['change_point_pdf'][idx] <= fmax/2.:
-            idx_upper = idx
-            break
-    # negative direction
-    for idx in np.arange(max_idx, -1, -1):
-        if D['change_point_pdf'][idx] <= fmax/2.:
-            idx_lower = idx
-            break
-    # Now calculate the width
-    if np.logical_and(idx_upper is not None, idx_lower is not None):
-        return D['depth_cells'][idx_upper] - D['depth_cells'][idx_lower]
-    else:
+    fwhm = batch_full_width_half_max(D['change_point_pdf'], D['depth_cells'],
+                                     max_idx, fmax)[0]
+    if np.isnan(fwhm):
         return None
+    return fwhm
 
+def fwhm2stdev(fwhm, stdev_ceiling = 50.):
+    """Convert full width at half maximum to standard deviations, using the
+    ceiling where the width is nan.
+    """
+    # from https://en.wikipedia.org/wiki/Full_width_at_half_maximum
+    stdev = np.asarray(fwhm)/(2*np.sqrt(2*np.log(2)))
+    return np.where(np.isnan(stdev), stdev_ceiling, stdev)
 
 def click2estimate(D, yclick, snap_window = 16, stdev_ceiling = 50.):
     """Function for snapping to a layer point probability maximum from a click
@@ -348,3 +907,102 @@ def click2estimate(D, yclick, snap_window = 16, stdev_ceiling = 50.):
     else:
         stdev = stdev_ceiling
     return interpreted_depth, stdev
+
+def batch_click2estimate(D, yclicks, sounding_index = None, snap_window = 16,
+                         stdev_ceiling = 50.):
+    """Snap many clicks to layer point probability maxima at once.
+
+    Parameters
+    ----------
+    D: dictionary
+        Dictionary of rj sounding data where 'change_point_pdf' has shape
+        (n_soundings, n_depth)
+    yclicks : array
+        Depth of each click.
+    sounding_index : array
+        Index of the sounding in D for each click. If None there must be one
+        click per sounding.
+
+    Returns
+    -------
+    interpreted_depth
+        Array of depths of the probability maxima. Nan where there are no
+        depth cells within the snap window
+    stdev
+        Array of standard deviations. Nan where there are no depth cells
+        within the snap window
+
+    """
+    change_point_pdf = np.atleast_2d(D['change_point_pdf'])
+    depth_cells = np.asarray(D['depth_cells'])
+    yclicks = np.asarray(yclicks, dtype = np.float64).ravel()
+
+    if sounding_index is None:
+        sounding_index = np.arange(change_point_pdf.shape[0])
+
+    pdfs = change_point_pdf[sounding_index]
+
+    # Mask the cells outside of each snap window
+    ymin = yclicks[:, np.newaxis] - snap_window/2
+    ymax = yclicks[:, np.newaxis] + snap_window/2
+    window = (depth_cells > ymin) & (depth_cells < ymax)
+
+    idx_max = np.argmax(np.where(window, pdfs, -np.inf), axis = 1)
+    fmax = pdfs[np.arange(len(idx_max)), idx_max]
+
+    fwhm = batch_full_width_half_max(pdfs, depth_cells, idx_max, fmax)
+
+    # Clicks with no cells in their snap window have no estimate
+    valid = np.any(window, axis = 1)
+
+    interpreted_depth = np.where(valid, depth_cells[idx_max], np.nan)
+    stdev = np.where(valid, fwhm2stdev(fwhm, stdev_ceiling), np.nan)
+
+    return interpreted_depth, stdev
+
+def auto_pick(D, k = 1, min_probability = 0., stdev_ceiling = 50.):
+    """Pick the k largest change point probability peaks for every sounding.
+
+    Parameters
+    ----------
+    D: dictionary
+        Dictionary of rj sounding data where 'change_point_pdf' has shape
+        (n_soundings, n_depth)
+    k : integer
+        Number of peaks to pick for each sounding
+    min_probability : float
+        Peaks with a lower change point probability are ignored
+
+    Returns
+    -------
+    interpreted_depth
+        Array of shape (n_soundings, k) with the peak depths, ordered from the
+        most to least probable. Nan where a sounding has fewer than k peaks
+    stdev
+        Array of shape (n_soundings, k) of standard deviations
+    probability
+        Array of shape (n_soundings, k) of change point probabilities
+
+    """
+    pdfs = np.atleast_2d(D['change_point_pdf']).astype(np.float64)
+    depth_cells = np.asarray(D['depth_cells'])
+
+    # A peak is greater than the cell above and at least as large as the cell below
+    padded = np.pad(pdfs, ((0, 0), (1, 1)), mode = 'constant', constant_values = -np.inf)
+    peaks = (pdfs > padded[:, :-2]) & (pdfs >= padded[:, 2:]) & (pdfs > min_probability)
+
+    k = min(k, pdfs.shape[1])
+    scores = np.where(peaks, pdfs, -np.inf)
+    idx = np.argsort(-scores, axis = 1, kind = 'stable')[:, :k]
+
+    rows = np.arange(pdfs.shape[0])[:, np.newaxis]
+    valid = peaks[rows, idx]
+    probability = pdfs[rows, idx]
+
+    fwhm = batch_full_width_half_max(np.repeat(pdfs, k, axis = 0), depth_cells,
+                                     idx.ravel(), probability.ravel()).reshape(idx.shape)
+
+    interpreted_depth = np.where(valid, depth_cells[idx], np.nan)
+    stdev = np.where(valid, fwhm2stdev(fwhm, stdev_ceiling), np.nan)
+
+    return interpreted_depth, stdev, np.where(valid, probability, np.nan)
@@ -25,9 +25,26 @@ Utility functions for dealing with netcdf data
 '''
 
 import netCDF4
+import os
+import re
 import numpy as np
 import spatial_functions
 import pandas as pd
+import weakref
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Line indices are built once per dataset and cached here. Weak references
+# mean the cache entry disappears with the dataset.
+_line_index_cache = weakref.WeakKeyDictionary()
+
+# Nearest lci point for every rj point, cached against the rj and then lci
+# datasets
+_lci_association_cache = weakref.WeakKeyDictionary()
+
+# netCDF4 is not thread safe so reads from background threads hold this lock
+netcdf_lock = threading.RLock()
 
 def object2array(variable, dtype):
     """Helper function for converting single variables to a list
@@ -51,6 +68,156 @@ def object2array(variable, dtype):
     else:
         return variable
 
+class LineIndex:
+    """
+    CSR-style lookup from AEM line number to point indices. The line_index
+    variable is read once and the points are stably sorted by line so that
+    the point indices for any line can be returned without a further pass
+    over the dataset.
+    """
+
+    def __init__(self, netCDF_dataset):
+        """Initialise the line index.
+
+        Parameters
+        ----------
+        netCDF_dataset : object
+            netcdf dataset with variables 'line' and 'line_index'
+
+        """
+        self.lines = np.ma.getdata(netCDF_dataset['line'][:])
+        line_index = np.ma.getdata(netCDF_dataset['line_index'][:]).astype(np.int64)
+        self.npoints = line_index.shape[0]
+        # Stable sort keeps the points within each line in ascending order
+        self.permutation = np.argsort(line_index, kind = 'stable')
+        counts = np.bincount(line_index, minlength = len(self.lines))
+        self.offsets = np.zeros(shape = len(counts) + 1, dtype = np.int64)
+        self.offsets[1:] = np.cumsum(counts)
+        # Dictionary for finding the position of a line number in O(1)
+        self.positions = {line: i for i, line in enumerate(self.lines.tolist())}
+
+    def point_indices(self, line):
+        """Get the point indices for a single line.
+
+        Parameters
+        ----------
+        line : integer
+            AEM line number.
+
+        Returns
+        -------
+        array
+            Ascending array of point indices. Empty if the line is not in the
+            dataset.
+
+        """
+        i = self.positions.get(line)
+        if i is None:
+            return np.zeros(shape = 0, dtype = np.int64)
+        return self.permutation[self.offsets[i]:self.offsets[i + 1]]
+
+    def point_selection(self, line):
+        """Get an object for indexing netcdf variables for a single line. If the
+        points are stored contiguously a slice is returned, which is much faster
+        to read from a netcdf file than an array of indices.
+
+        Parameters
+        ----------
+        line : integer
+            AEM line number.
+
+        Returns
+        -------
+        slice or array
+            Selection along the point dimension.
+
+        """
+        inds = self.point_indices(line)
+        if len(inds) > 0 and inds[-1] - inds[0] + 1 == len(inds):
+            return slice(int(inds[0]), int(inds[-1]) + 1)
+        return inds
+
+    def mask(self, lines):
+        """Get a boolean point mask for one or more lines.
+
+        Parameters
+        ----------
+        lines : array like
+            array of line numbers
+
+        Returns
+        -------
+        boolean array
+            Boolean mask for lines
+
+        """
+        mask = np.zeros(shape = self.npoints, dtype = bool)
+        for line in lines:
+            mask[self.point_indices(line)] = True
+        return mask
+
+def get_line_index(dataset, rebuild = False):
+    """Get the cached line index for a dataset, building it if need be.
+
+    Parameters
+    ----------
+    dataset : object
+        netcdf dataset with variables 'line' and 'line_index'
+    rebuild : boolean
+        If True the line index is rebuilt even if one is cached.
+
+    Returns
+    -------
+    object
+        LineIndex instance
+
+    """
+    if rebuild or dataset not in _line_index_cache:
+        _line_index_cache[dataset] = LineIndex(dataset)
+    return _line_index_cache[dataset]
+
+def get_line_distances(dataset, variable_name = 'line_distance', save = False):
+    """Get the along-line distance of every point in the dataset. If the
+    dataset does not have the derived distance variable the distances are
+    calculated for all lines in one pass using the line index.
+
+    Parameters
+    ----------
+    dataset : object
+        netcdf dataset with variables 'line', 'line_index', 'easting',
+        'northing' and 'fiducial'
+    variable_name : string
+        Name of the derived distance variable.
+    save : boolean
+        If True the calculated distances are written to the dataset as a
+        derived variable so later gridding runs can reuse them. The dataset
+        must be open in append mode.
+
+    Returns
+    -------
+    array
+        Array of along-line distances for every point
+
+    """
+    if variable_name in dataset.variables:
+        return np.ma.getdata(dataset[variable_name][:])
+
+    line_index = get_line_index(dataset)
+
+    coords = np.column_stack((np.ma.getdata(dataset['easting'][:]),
+                              np.ma.getdata(dataset['northing'][:])))
+
+    distances = spatial_functions.line_coords2distance(coords,
+                                                       np.ma.getdata(dataset['fiducial'][:]),
+                                                       [line_index.point_indices(line) for line in line_index.lines])
+    if save:
+        var = dataset.createVariable(variable_name, distances.dtype, ('point',))
+        var[:] = distances
+        var.long_name = 'Distance along line from the first point of the line'
+        var.units = 'm'
+
+    return distances
+
 def get_lines(dataset, line_numbers, variables):
     """
     A function for extracting variables from a particular AEM line
@@ -70,44 +237,112 @@ def get_lines(dataset, line_numbers, variables):
         raise ValueError("Input datafile is not netCDF4 format")
         return None
 
+    line_index = get_line_index(dataset)
+
     # Iterate through lines and get the point indices
     for line in line_numbers:
-        point_mask = dataset['line_index'][:] == np.where(dataset['line'][:] == line)[0]
+        point_selection = line_index.point_selection(line)
+        npoints = len(line_index.point_indices(line))
         # Iterate through the variables and add the masked arrays to a dictionary
         line_dict = {}
 
         for var in variables:
             if dataset[var].dimensions[0] == 'point':
-                line_dict[var] = dataset[var][point_mask]
+                line_dict[var] = dataset[var][point_selection]
             elif dataset[var].dimensions[0] == 'depth':
-                line_dict[var] = np.tile(dataset[var][:], [point_mask.sum(),1])
+                line_dict[var] = np.tile(dataset[var][:], [npoints,1])
 
         yield line, line_dict
 
-def extract_rj_sounding(rj, lci, point_index = 0):
-    """
-    TODO: clean up this function or consider removing!!!
+def get_lci_association(rj, lci, max_distance = 100.):
+    """Find the nearest lci point to every rj point. This is computed once
+    for each pair of datasets and cached.
+
+    Parameters
+    ----------
+    rj : object
+        AEM_inversion instance with rj data
+    lci : object
+        AEM_inversion instance with lci data
+    max_distance : float
+        Maximum distance between associated points
+
+    Returns
+    -------
+    array
+        Index of the nearest lci point for each rj point, or -1 where there
+        is no lci point within max_distance
+
     """
+    cache = _lci_association_cache.setdefault(rj.data, weakref.WeakKeyDictionary())
+    associations = cache.setdefault(lci.data, {})
+
+    if max_distance not in associations:
+        coords = np.column_stack((rj.data['easting'][:], rj.data['northing'][:]))
+        distances, indices = spatial_functions.nearest_neighbours(coords,
+                                                                  lci.spatial_index,
+                                                                  max_distance = max_distance)
+        indices = np.where(np.isnan(distances), -1, indices).astype(np.int64)
+        associations[max_distance] = indices
+
+    return associations[max_distance]
+
+def _read_associated(variable, indices):
+    # Read the rows of a point variable for the associated points, with nan
+    # rows where there is no associated point
+    valid = indices >= 0
+    out = np.full((len(indices),) + variable.shape[1:], np.nan)
+    if np.any(valid):
+        out[valid] = np.ma.filled(read_points(variable, indices[valid]).astype(np.float64),
+                                  np.nan)
+    return out
+
+def extract_rj_soundings(rj, lci, point_index = slice(None)):
+    """Extract many rj soundings and their associated lci data as arrays,
+    reading each variable once.
 
+    Parameters
+    ----------
+    rj : object
+        AEM_inversion instance with rj data
+    lci : object
+        AEM_inversion instance with lci data
+    point_index : slice or array
+        Slice or array of rj point indices
+
+    Returns
+    -------
+    dictionary
+        Dictionary of arrays where the first axis is the point. Values that
+        are the same for every point (e.g. 'depth_cells') are stored once.
+        Lci values are nan where there is no lci point within 100 m
+
+    """
     rj_dat = rj.data
     lci_dat = lci.data
 
-    freq = rj_dat['log10conductivity_histogram'][point_index].data.astype(np.float)
+    if isinstance(point_index, slice):
+        point_index = np.arange(rj_dat.dimensions['point'].size)[point_index]
+    point_index = np.asarray(point_index, dtype = np.int64).ravel()
+
+    freq = np.ma.getdata(read_points(rj_dat['log10conductivity_histogram'],
+                                     point_index)).astype(np.float64)
 
-    easting = np.float(rj_dat['easting'][point_index].data)
-    northing = np.float(rj_dat['northing'][point_index].data)
+    # The number of samples is the sum of any depth row of the histogram
+    nsamples = freq[:, 0, :].sum(axis = 1)
 
-    cond_pdf = freq / freq.sum(axis =1)[0]
+    cond_pdf = freq / nsamples[:, np.newaxis, np.newaxis]
 
     cond_pdf[cond_pdf == 0] = np.nan
 
-    cp_freq = rj_dat["interface_depth_histogram"][point_index].data.astype(np.float)
+    cp_freq = np.ma.getdata(read_points(rj_dat["interface_depth_histogram"],
+                                        point_index)).astype(np.float64)
 
-    cp_pdf = cp_freq / freq.sum(axis =1)[0]
+    cp_pdf = cp_freq / nsamples[:, np.newaxis]
 
-    laybins = rj_dat['nlayers_histogram'][point_index].data
+    laybins = np.ma.getdata(read_points(rj_dat['nlayers_histogram'], point_index))
 
-    lay_prob = laybins / freq.sum(axis =1)[0]
+    lay_prob = laybins / nsamples[:, np.newaxis]
 
     condmin, condmax = rj_dat.min_log10_conductivity, rj_dat.max_log10_conductivity
 
@@ -115,52 +350,344 @@ def extract_rj_sounding(rj, lci, point_index = 0):
 
     cond_cells = np.linspace(condmin, condmax, ncond_cells)
 
-    pmin, pmax = rj_dat.min_depth, rj_dat.max_depth
-
     depth_cells = rj_dat['layer_centre_depth'][:]
 
     extent = [cond_cells.min(), cond_cells.max(), depth_cells.max(), depth_cells.min()]
 
-    mean = np.power(10,rj_dat['conductivity_mean'][point_index].data)
-    p10 = np.power(10,rj_dat['conductivity_p10'][point_index].data)
-    p50 = np.power(10,rj_dat['conductivity_p50'][point_index].data)
-    p90 = np.power(10,rj_dat['conductivity_p90'][point_index].data)
+    D = {'conductivity_pdf': cond_pdf, "change_point_pdf": cp_pdf, "conductivity_extent": extent,
+         'depth_cells': depth_cells, 'nlayer_bins': laybins, 'nlayer_prob': lay_prob,
+         'nsamples': rj_dat.nsamples, 'ndata': rj_dat.dimensions['data'].size,
+         "nchains": rj_dat.nchains, 'burnin': rj_dat.nburnin,
+         'sample_no': np.arange(1,rj_dat.dimensions['convergence_sample'].size + 1),
+         'cond_cells': cond_cells, 'point_index': point_index}
 
-    lci_coords = np.column_stack
+    for key, var in [('cond_mean', 'conductivity_mean'), ('cond_p10', 'conductivity_p10'),
+                     ('cond_p50', 'conductivity_p50'), ('cond_p90', 'conductivity_p90')]:
+        D[key] = np.power(10, np.ma.getdata(read_points(rj_dat[var], point_index)))
 
-    distances, indices = spatial_functions.nearest_neighbours([easting, northing],
-                                                              lci.coords,
-                                                               max_distance = 100.)
-    point_ind_lci = indices[0]
+    D['misfit'] = np.ma.getdata(read_points(rj_dat['misfit'], point_index))
 
-    lci_cond = lci_dat['conductivity'][point_ind_lci].data
-    lci_depth_top = lci_dat['layer_top_depth'][point_ind_lci].data
+    for key in ['easting', 'northing', 'fiducial', 'elevation']:
+        D[key] = np.ma.getdata(read_points(rj_dat[key], point_index)).astype(np.float64)
 
-    lci_doi = lci_dat['depth_of_investigation'][point_ind_lci].data
+    # get line under new schema
+    line_index = np.ma.getdata(read_points(rj_dat['line_index'], point_index)).astype(np.int64)
+    D['line'] = np.ma.getdata(rj_dat['line'][:])[line_index].astype(np.int64)
+
+    # Lci data for the associated points
+    lci_index = get_lci_association(rj, lci)[point_index]
+
+    D['lci_index'] = lci_index
+    D['lci_cond'] = _read_associated(lci_dat['conductivity'], lci_index)
+    D['lci_depth_top'] = _read_associated(lci_dat['layer_top_depth'], lci_index)
+    D['lci_doi'] = _read_associated(lci_dat['depth_of_investigation'], lci_index)
+
+    # Distance along the gridded lci section for each line
+    D['lci_dist'] = np.full(len(point_index), np.nan)
+
+    section_data = getattr(lci, 'section_data', None)
+
+    if section_data is not None:
+        coords = np.column_stack((D['easting'], D['northing']))
+        for line in np.unique(D['line']):
+            if line not in section_data:
+                continue
+            mask = D['line'] == line
+            grid_dict = section_data[line]
+            distances, indices = spatial_functions.nearest_neighbours(coords[mask],
+                                                                      spatial_functions.get_section_index(grid_dict),
+                                                                      max_distance=100.)
+            found = ~np.isnan(distances)
+            dist = np.full(len(distances), np.nan)
+            dist[found] = grid_dict['grid_distances'][indices[found]]
+            D['lci_dist'][mask] = dist
+
+    return D
+
+# Values in the extract_rj_soundings dictionary with an entry for each point
+_sounding_point_keys = ['conductivity_pdf', 'change_point_pdf', 'nlayer_bins', 'nlayer_prob',
+                        'cond_mean', 'cond_p10', 'cond_p50', 'cond_p90', 'misfit',
+                        'lci_cond', 'lci_depth_top', 'lci_doi', 'elevation']
+
+def _shared_sounding_values(D):
+    # Values in the extract_rj_soundings dictionary that are the same for
+    # every point
+    return {key: value for key, value in D.items() if key not in _sounding_point_keys and
+            key not in ['easting', 'northing', 'fiducial', 'line', 'lci_dist',
+                        'point_index', 'lci_index']}
+
+def split_rj_soundings(D, lci, shared = None):
+    """Split the dictionary from extract_rj_soundings into a list with a
+    dictionary for each sounding. The values for each point are copied so
+    they do not keep the arrays for the other points alive, while the values
+    that are the same for every point are shared between the soundings.
+
+    If shared is given its values are used instead of those in D, so that
+    soundings from different extractions can share them.
+    """
+    if shared is None:
+        shared = _shared_sounding_values(D)
+    soundings = []
 
-    misfit = rj_dat['misfit'][point_index].data
+    for i in range(len(D['point_index'])):
+        sounding = shared.copy()
+        # Take the values for our single point
+        for key in _sounding_point_keys:
+            sounding[key] = D[key][i].copy()
 
-    burnin = rj_dat.nburnin
-    nsamples = rj_dat.nsamples
-    sample_no = np.arange(1,rj_dat.dimensions['convergence_sample'].size + 1)
-    nchains = rj_dat.nchains
-    elevation = rj_dat['elevation'][point_index]
-    # get line under new schema
-    line_index = int(rj_dat['line_index'][point_index])
-    line = int(rj_dat['line'][line_index])
-    fiducial = float(rj_dat['fiducial'][point_index])
-    elevation = rj_dat['elevation'][point_index]
-
-    dist = spatial_functions.xy_2_var(lci.section_data[line],
-                                      np.array([[easting, northing]]),
-                                      'grid_distances')
-
-    return {'conductivity_pdf': cond_pdf, "change_point_pdf": cp_pdf, "conductivity_extent": extent,
-           'cond_p10': p10, 'cond_p50': p50, 'cond_p90': p90, 'cond_mean': mean, 'depth_cells': depth_cells,
-           'nlayer_bins': laybins, 'nlayer_prob': lay_prob, 'nsamples': nsamples, 'ndata': rj_dat.dimensions['data'].size,
-           "nchains": nchains, 'burnin': burnin, 'misfit': misfit, 'sample_no': sample_no, 'cond_cells': cond_cells, 'lci_cond': lci_cond,
-           'lci_depth_top': lci_depth_top, 'lci_doi': lci_doi, 'line': line, 'northing': northing, 'easting': easting, 'fiducial':fiducial,
-           'elevation': elevation, 'lci_dist': dist, 'lci_line': lci.section_data[line]}
+        for key in ['easting', 'northing', 'fiducial']:
+            sounding[key] = float(D[key][i])
+
+        sounding['line'] = int(D['line'][i])
+        sounding['lci_dist'] = None if np.isnan(D['lci_dist'][i]) else D['lci_dist'][i]
+        sounding['lci_line'] = lci.section_data[sounding['line']]
+        soundings.append(sounding)
+
+    return soundings
+
+def extract_rj_sounding(rj, lci, point_index = 0):
+    """Extract a single rj sounding and its associated lci data. See
+    extract_rj_soundings for extracting many soundings at once.
+    """
+    return split_rj_soundings(extract_rj_soundings(rj, lci, [point_index]), lci)[0]
+
+def _sounding_nbytes(D):
+    # Memory used by the arrays that belong to a single sounding. The shared
+    # values are held once by the cache so are not counted
+    return sum(D[key].nbytes for key in _sounding_point_keys if isinstance(D[key], np.ndarray))
+
+class SoundingCache:
+    """
+    Bounded least recently used cache of rj sounding dictionaries, keyed by
+    the rj dataset and point index.
+
+    Soundings either side of a requested sounding along its line, ordered by
+    fiducial, can be prefetched in a background thread so that stepping along
+    a line does not wait on netCDF reads. The cache reads rj.data and lci.data
+    while holding netcdf_lock, and as netCDF4 is not thread safe any other
+    reads of those datasets must also hold netcdf_lock while prefetching is on.
+    """
+    def __init__(self, rj, lci, max_bytes = 512 * 1024**2, prefetch = 0):
+        """Initialise the sounding cache.
+
+        Parameters
+        ----------
+        rj : object
+            AEM_inversion instance with rj data
+        lci : object
+            AEM_inversion instance with lci data
+        max_bytes : integer
+            Memory ceiling for the arrays of the cached soundings. The least
+            recently used soundings are evicted once this is exceeded. Values
+            that are the same for every sounding (e.g. 'depth_cells') are held
+            once and are not counted
+        prefetch : integer
+            Number of neighbouring soundings either side of a requested
+            sounding to load in the background. If 0 there is no prefetching
+
+        """
+        self.rj = rj
+        self.lci = lci
+        # Read the path once as the cache keys are built without netcdf_lock
+        with netcdf_lock:
+            self._filepath = rj.data.filepath()
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._cache = OrderedDict()
+        self._shared = None
+        self._pending = {}
+        self._line_order = {}
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers = 1) if prefetch > 0 else None
+
+    def _key(self, point_index):
+        return (self._filepath, int(point_index))
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, point_index):
+        return self._key(point_index) in self._cache
+
+    def _insert(self, point_index, D):
+        with self._lock:
+            key = self._key(point_index)
+            if key in self._cache:
+                return
+            self._cache[key] = D
+            self.nbytes += _sounding_nbytes(D)
+            # Evict the least recently used soundings, always keeping the newest
+            while self.nbytes > self.max_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last = False)
+                self.nbytes -= _sounding_nbytes(evicted)
+
+    def _load(self, point_indices):
+        with netcdf_lock:
+            D = extract_rj_soundings(self.rj, self.lci, point_indices)
+        with self._lock:
+            if self._shared is None:
+                self._shared = _shared_sounding_values(D)
+        soundings = split_rj_soundings(D, self.lci, self._shared)
+        for point_index, sounding in zip(point_indices, soundings):
+            self._insert(point_index, sounding)
+        return soundings
+
+    def get(self, point_index):
+        """Get the sounding dictionary for a point, reading it if it is not
+        cached.
+
+        Parameters
+        ----------
+        point_index : integer
+            Index of the rj point
+
+        Returns
+        -------
+        dictionary
+            Sounding dictionary as returned by extract_rj_sounding
+
+        """
+        key = self._key(point_index)
+
+        # Wait for the point if it is being prefetched
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None:
+            # A failed prefetch is retried below
+            future.exception()
+
+        with self._lock:
+            D = self._cache.get(key)
+            if D is not None:
+                self.hits += 1
+                self._cache.move_to_end(key)
+            else:
+                self.misses += 1
+
+        if D is None:
+            D = self._load([point_index])[0]
+
+        if self.prefetch > 0:
+            self._prefetch(point_index)
+
+        return D
+
+    __getitem__ = get
+
+    def neighbours(self, point_index, n):
+        """Find the n points either side of a point along its line, ordered
+        by fiducial.
+        """
+        with netcdf_lock:
+            line = int(self.rj.data['line_index'][point_index])
+            if line not in self._line_order:
+                point_indices = get_line_index(self.rj.data).point_indices(
+                                        int(self.rj.data['line'][line]))
+                fiducials = read_points(self.rj.data['fiducial'], point_indices)
+                self._line_order[line] = point_indices[np.argsort(fiducials, kind = 'stable')]
+        order = self._line_order[line]
+        pos = np.where(order == point_index)[0][0]
+        return order[max(pos - n, 0):pos + n + 1]
+
+    def _prefetch(self, point_index):
+        with netcdf_lock:
+            neighbours = self.neighbours(point_index, self.prefetch)
+        with self._lock:
+            missing = [int(i) for i in neighbours if self._key(i) not in self._cache
+                       and self._key(i) not in self._pending]
+            if len(missing) == 0:
+                return
+            future = self._executor.submit(self._load, missing)
+            for i in missing:
+                self._pending[self._key(i)] = future
+
+        def done(future, keys = [self._key(i) for i in missing]):
+            with self._lock:
+                for key in keys:
+                    self._pending.pop(key, None)
+
+        future.add_done_callback(done)
+
+    def clear(self):
+        """Remove all soundings from the cache and reset the counters."""
+        with self._lock:
+            self._cache.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def close(self):
+        """Stop the prefetching thread."""
+        if self._executor is not None:
+            self._executor.shutdown(wait = True)
+
+def read_points(variable, point_index, *index):
+    """Read the rows of a point variable for many points in a single read.
+
+    Parameters
+    ----------
+    variable : object
+        netCDF4 variable with point as the first dimension
+    point_index : slice or array
+        Slice or array of point indices
+    *index
+        Optional indices for the remaining dimensions
+
+    Returns
+    -------
+    ndarray
+        Array of rows in the order of point_index
+
+    """
+    if isinstance(point_index, slice):
+        return variable[(point_index,) + index]
+
+    point_index = np.asarray(point_index, dtype = np.int64).ravel()
+
+    if len(point_index) == 0:
+        return variable[(slice(0, 0),) + index]
+
+    # Read the sorted unique indices then reorder. A contiguous block is read
+    # as a slice as this is much faster than fancy indexing
+    unique, inverse = np.unique(point_index, return_inverse = True)
+
+    if unique[-1] - unique[0] + 1 == len(unique):
+        data = variable[(slice(unique[0], unique[-1] + 1),) + index]
+    else:
+        data = variable[(unique,) + index]
+
+    return data[inverse.ravel()]
+
+def extract_change_point_pdfs(rj_data, point_index = slice(None)):
+    """Extract the change point probability for many rj soundings.
+
+    Parameters
+    ----------
+    rj_data : object
+        netCDF4 dataset of rj-MCMC pmaps
+    point_index : slice or array
+        Slice or array of point indices
+
+    Returns
+    -------
+    dictionary
+        Dictionary with the 'change_point_pdf' array of shape
+        (n_points, n_depth) and 'depth_cells' array
+
+    """
+    # The number of samples is the sum of any depth row of the conductivity
+    # histogram so we only read the first row
+    nsamples = read_points(rj_data['log10conductivity_histogram'],
+                           point_index, 0).sum(axis = 1).astype(np.float64)
+
+    cp_freq = read_points(rj_data['interface_depth_histogram'],
+                          point_index).astype(np.float64)
+
+    return {'change_point_pdf': np.ma.getdata(cp_freq) / np.ma.getdata(nsamples)[:, np.newaxis],
+            'depth_cells': rj_data['layer_centre_depth'][:]}
 
 def testNetCDFDataset(netCDF_dataset):
     """Test if datafile is netcdf.
@@ -197,13 +724,11 @@ def get_lookup_mask(lines, netCDF_dataset):
     """
     lines = object2array(lines, int)
 
-    line_inds = np.where(np.isin(netCDF_dataset['line'][:], lines))[0]
-
-    return np.isin(netCDF_dataset['line_index'],line_inds)
+    return get_line_index(netCDF_dataset).mask(lines)
 
 def write_inversion_ready_file(dataset, outpath, nc_variables,
                                nc_formats, other_variables = None,
-                               mask = None):
+                               mask = None, streaming = False, chunk_size = None):
     """A function for writing an inversion ready.dat file. This file can be
      inverted using GA-AEM inversion algorithms.
 
@@ -231,13 +756,23 @@ def write_inversion_ready_file(dataset, outpath, nc_variables,
         e.g.{'rel_uncertainty_low_moment_Z-component':
              {'data': numpy array, 'format': {:15.6E}} }
     mask: boolean array
+    streaming: boolean
+        If True the point dimension is read and written in chunks so memory
+        use does not depend on the size of the dataset. See
+        write_inversion_ready_files
+    chunk_size: integer
+        Number of points in each chunk when streaming
 
     """
+    if streaming:
+        write_inversion_ready_files(dataset, [outpath], nc_variables, nc_formats,
+                                    other_variables = other_variables,
+                                    masks = [mask], chunk_size = chunk_size)
+        return
+
     # Now create a mask if none exists
     if mask is None:
-        mask = np.ones(shape = (dataset.dimensions['point'].size), dtype = np.bool)
-    # Create an empty dataframe
-    df = pd.DataFrame(index = range(mask.sum()))
+        mask = np.ones(shape = (dataset.dimensions['point'].size), dtype = bool)
 
     # Create a dictionary with arrays, formats and variable name
     data = {}
@@ -262,23 +797,200 @@ def write_inversion_ready_file(dataset, outpath, nc_variables,
             # apply mask
             data[item] = {'array': other_variables[item]['array'][mask],
                           'format': other_variables[item]['format']}
-    # build pandas dataframe
+
+    write_formatted_rows(data, outpath)
+
+    # Now write the .hdr file
+    write_header_file(data, outpath)
+
+def get_point_chunk_size(dataset, variables, chunk_size = None):
+    """Find a number of points to read at a time that is a multiple of the
+    netCDF chunking along the point dimension of the variables.
+
+    Parameters
+    ----------
+    dataset : object
+        Netcdf dataset
+    variables : list
+        List of variables that will be read
+    chunk_size : integer
+        Target number of points. Defaults to 100000
+
+    Returns
+    -------
+    integer
+        Number of points to read at a time
+
+    """
+    if chunk_size is None:
+        chunk_size = 100000
+
+    point_chunk = 1
+    for var in variables:
+        variable = dataset[var]
+        if len(variable.dimensions) == 0 or variable.dimensions[0] != 'point':
+            continue
+        chunking = variable.chunking()
+        if chunking != 'contiguous':
+            point_chunk = max(point_chunk, chunking[0])
+
+    # Round up to a whole number of netCDF chunks
+    return int(np.ceil(chunk_size / point_chunk) * point_chunk)
+
+def write_inversion_ready_files(dataset, outpaths, nc_variables, nc_formats,
+                                other_variables = None, masks = None,
+                                chunk_size = None):
+    """Write one or more inversion ready .dat files in a single pass over the
+    dataset. The point dimension is read in contiguous chunks aligned with the
+    netCDF chunking, so memory use depends on the chunk size rather than the
+    size of the dataset. The output is identical to write_inversion_ready_file.
+
+    Parameters
+    ----------
+    dataset : object
+        Netcdf dataset
+    outpaths : list
+        List of paths of inversion ready files.
+    nc_variables : list
+        List of variables from dataset. See write_inversion_ready_file
+    nc_formats : list
+        List of formats for variables.
+    other_variables : dictionary
+        dictionary of additional variables. See write_inversion_ready_file
+    masks : list
+        List of boolean point masks, one for each output file. A mask of None
+        writes every point. E.g. a mask for each flight.
+    chunk_size : integer
+        Target number of points to read at a time
+
+    """
+    npoints = dataset.dimensions['point'].size
+
+    if masks is None:
+        masks = [None] * len(outpaths)
+
+    assert len(masks) == len(outpaths)
+
+    masks = [np.ones(npoints, dtype = bool) if mask is None else np.asarray(mask)
+             for mask in masks]
+
+    point_variables = [var for var in nc_variables if var not in ['line', 'flight']]
+    point_variables += [var + '_index' for var in ['line', 'flight'] if var in nc_variables]
+
+    chunk_size = get_point_chunk_size(dataset, point_variables, chunk_size)
+
+    # The line and flight variables are small so they are read once
+    lookups = {var: dataset[var][:].data for var in ['line', 'flight'] if var in nc_variables}
+
+    # Truncate the output files
+    for outpath in outpaths:
+        open(outpath, 'w').close()
+
+    for start in range(0, max(npoints, 1), chunk_size):
+        chunk = slice(start, min(start + chunk_size, npoints))
+
+        # Skip chunks with no points for any of the outputs
+        if start > 0 and not any(np.any(mask[chunk]) for mask in masks):
+            continue
+
+        arrays = {}
+        for var in nc_variables:
+            if var in lookups:
+                arrays[var] = lookups[var][dataset[var + '_index'][chunk]]
+            # Scalar variables
+            elif len(dataset[var].shape) == 0:
+                arrays[var] = np.repeat(dataset[var][:].data, chunk.stop - chunk.start)
+            else:
+                arrays[var] = dataset[var][chunk].data
+
+        if other_variables is not None:
+            for item in other_variables.keys():
+                arrays[item] = other_variables[item]['array'][chunk]
+
+        formats = dict(zip(nc_variables, nc_formats))
+        if other_variables is not None:
+            formats.update({item: other_variables[item]['format'] for item in other_variables})
+
+        for outpath, mask in zip(outpaths, masks):
+            chunk_mask = mask[chunk]
+            data = {item: {'array': arrays[item][chunk_mask], 'format': formats[item]}
+                    for item in arrays}
+            if np.any(chunk_mask):
+                write_formatted_rows(data, outpath, mode = 'a')
+            # Now write the .hdr file using the shapes from the first chunk
+            if start == 0:
+                write_header_file(data, outpath)
+
+# Python format specifications that have an identical printf-style equivalent
+_printf_spec = re.compile(r"^\{:([+ #0]*\d*(?:\.\d+)?[dxXoeEfFgG])\}$")
+
+def format_to_printf(fmt):
+    """Convert a str.format style format, e.g. '{:15.6E}', to the equivalent
+    printf-style format, e.g. '%15.6E'. Returns None if there is no exact
+    equivalent.
+    """
+    match = _printf_spec.match(fmt)
+    if match is None:
+        return None
+    return '%' + match.group(1)
+
+def _csv_quote(row):
+    # Quote a row the way pandas.to_csv does for a single column of strings
+    if row == '':
+        return '""'
+    if any(c in row for c in ',"\r\n'):
+        return '"' + row.replace('"', '""') + '"'
+    return row
+
+def write_formatted_rows(data, outpath, chunk_size = 10000, mode = 'w'):
+    """Write the arrays in a data dictionary as fixed width rows.
+
+    Parameters
+    ----------
+    data : dictionary
+        Dictionary of variables with 'array' and 'format' keys. 2D arrays are
+        written as a column per element of the second axis
+    outpath : string
+        Path of the output file.
+    chunk_size : integer
+        Number of rows to format and write at a time.
+    mode : string
+        File mode. Use 'a' to append to an existing file.
+
+    """
+    # Flatten into a list of columns with a printf format for each
+    columns = []
     for item in data:
-        print(item)
         arr = data[item]['array']
-
+        fmt = data[item]['format']
         if len(arr.shape) < 2:
-            df[item] = [data[item]['format'].format(x) for x in arr]
+            columns.append((arr, fmt))
         # For 3d variables like the EM data
         else:
-            for i in range(arr.shape[1]):
-                df[item + '_' + str(i+1)] = [data[item]['format'].format(x) for x in arr[:,i]]
-    # Note use a pipe so we can easily delete later
-
-    df.apply(lambda row: ''.join(map(str, row)), axis=1).to_csv(outpath, sep = ',', index = False, header = False)
-
-    # Now write the .hdr file
-    header_file = '.'.join(outfile.split('.')[:-1]) + '.hdr'
+            columns += [(arr[:,i], fmt) for i in range(arr.shape[1])]
+
+    row_format = ''.join(format_to_printf(fmt) or '%s' for _, fmt in columns)
+
+    nrows = columns[0][0].shape[0] if len(columns) > 0 else 0
+
+    with open(outpath, mode, newline = '', encoding = 'utf-8') as f:
+        for start in range(0, nrows, chunk_size):
+            end = min(start + chunk_size, nrows)
+            values = []
+            for arr, fmt in columns:
+                if format_to_printf(fmt) is not None:
+                    values.append(arr[start:end].tolist())
+                else:
+                    # No printf equivalent so fall back on str.format
+                    values.append([fmt.format(x) for x in arr[start:end]])
+            rows = [row_format % row for row in zip(*values)]
+            f.write(os.linesep.join(_csv_quote(row) for row in rows) + os.linesep)
+
+def write_header_file(data, outpath):
+    """Write the .hdr file that describes the columns of an inversion ready
+    file.
+    """
+    header_file = '.'.join(outpath.split('.')[:-1]) + '.hdr'
     counter = 1
     with open(header_file, 'w') as f:
         for item in data.keys():
@@ -316,23 +1028,25 @@ def get_sorted_line_inds(dataset, line, how = "east-west", subset = 1):
     err_message = 'Please specify one of \'east-west\', \'west-east\',\'north-south\', or \'south-north\''
     assert how in ['east-west', 'west-east', 'north-south', 'south-north'], err_message
     # get line indices
-    line_inds = np.where(get_lookup_mask([line],dataset))[0]
-
-    sort_mask = line_inds[np.argsort(dataset['fiducial'][line_inds])]
+    line_index = get_line_index(dataset)
+    line_inds = line_index.point_indices(line)
+    point_selection = line_index.point_selection(line)
 
-    #sort_mask = dataset['fiducial']
     # sort first on fiducials
-    if how == 'east-west':
-        if dataset['easting'][sort_mask][0] < dataset['easting'][sort_mask][-1]:
-            sort_mask = sort_mask[::-1]
-    elif how == 'west-east':
-        if dataset['easting'][sort_mask][0] > dataset['easting'][sort_mask][-1]:
-            sort_mask = sort_mask[::-1]
-    elif how == 'north-south':
-        if dataset['northing'][sort_mask][0] < dataset['northing'][sort_mask][-1]:
+    fiducial_sort = np.argsort(dataset['fiducial'][point_selection])
+    sort_mask = line_inds[fiducial_sort]
+
+    # Read the coordinate variable for the line once
+    if how in ['east-west', 'west-east']:
+        coords = dataset['easting'][point_selection][fiducial_sort]
+    else:
+        coords = dataset['northing'][point_selection][fiducial_sort]
+
+    if how in ['east-west', 'north-south']:
+        if coords[0] < coords[-1]:
             sort_mask = sort_mask[::-1]
-    elif how == 'south-north':
-        if dataset['northing'][sort_mask][0] > dataset['northing'][sort_mask][-1]:
+    else:
+        if coords[0] > coords[-1]:
             sort_mask = sort_mask[::-1]
 
     return sort_mask[::subset]
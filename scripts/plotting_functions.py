@@ -524,7 +524,15 @@ def pmap_plot(D, pmap_kwargs, surface, lci, figsize = (8,8), outfile = None):
 
     dist = D['lci_dist']
 
-    res1 = plot_single_line(ax5, D['lci_line'],
+    # For lazily loaded sections we only read the part of the line we plot
+    if hasattr(D['lci_line'], 'get_window'):
+        lci_line = D['lci_line'].get_window(dist, max(pmap_kwargs['panel_5']['buffer'],
+                                                      pmap_kwargs['panel_6']['buffer']),
+                                            variables = ['data_residual', 'conductivity'])
+    else:
+        lci_line = D['lci_line']
+
+    res1 = plot_single_line(ax5, lci_line,
                                  'data_residual', pmap_kwargs['panel_5'])
 
     ax5.set_title('LCI conductivity section - ' + str(line))
@@ -534,7 +542,7 @@ def pmap_plot(D, pmap_kwargs, surface, lci, figsize = (8,8), outfile = None):
     # Find distance along the lci section
 
 
-    im2 = plot_grid(ax6, D['lci_line'], 'conductivity',
+    im2 = plot_grid(ax6, lci_line, 'conductivity',
                               panel_kwargs = pmap_kwargs['panel_6'])
 
     ax6.plot([dist, dist], [-1000, 1000], 'pink')
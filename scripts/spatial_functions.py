@@ -28,8 +28,13 @@ import numpy as np
 from scipy.interpolate import griddata
 from scipy.interpolate import interp1d
 import math
+import pickle
+import weakref
 from shapely.geometry import Point
 
+# Spatial indices for gridded sections cached against their coordinate arrays
+_spatial_index_cache = {}
+
 def depth_to_thickness(depth):
     """
     Function for calculating thickness from depth array
@@ -69,35 +74,178 @@ def thickness_to_depth(thickness):
 
     return depth
 
+class SpatialIndex:
+    """
+    KD-tree spatial index for a set of coordinates. The tree is built the
+    first time it is queried and the index can be pickled or saved to disk.
+    """
+
+    def __init__(self, coords):
+        """Initialise the spatial index.
+
+        Parameters
+        ----------
+        coords : array
+            Array of shape (n, 2) with the coordinates of the points.
+
+        """
+        self.coords = np.asarray(coords)
+        self._kdtree = None
+
+    @property
+    def kdtree(self):
+        """The KD-tree, which is built on first access."""
+        if self._kdtree is None:
+            self._kdtree = cKDTree(data=self.coords)
+        return self._kdtree
+
+    def query(self, points, points_required = 1, max_distance = np.inf):
+        """Find the nearest neighbours for a batch of points.
+
+        Parameters
+        ----------
+        points : array
+            Array of points to find the nearest neighbours for.
+        points_required : integer
+            Number of neighbours to return for each point.
+        max_distance : float
+            Maximum search radius.
+
+        Returns
+        -------
+        distances, indices
+            Distances are nan and indices are equal to the number of points in
+            the index where no neighbour was found within max_distance.
+
+        """
+        if len(np.array(points).shape) == 1:
+            points = np.array([points])
+
+        distances, indices = self.kdtree.query(points, k=points_required,
+                                               distance_upper_bound=max_distance)
+
+        # Mask out infitnite distances in indices to avoid confusion
+        mask = np.isfinite(distances)
+
+        if not np.all(mask):
+
+            distances[~mask] = np.nan
+
+        return distances, indices
+
+    def query_radius(self, points, radius):
+        """Find all of the points within a radius for a batch of points.
+
+        Parameters
+        ----------
+        points : array
+            Array of points to search around.
+        radius : float
+            Search radius.
+
+        Returns
+        -------
+        array
+            Object array with a sorted list of point indices for each point.
+
+        """
+        if len(np.array(points).shape) == 1:
+            points = np.array([points])
+
+        return self.kdtree.query_ball_point(points, r=radius, return_sorted=True)
+
+    def save(self, outfile):
+        """Save the spatial index, including the built tree, to a pickle file.
+
+        Parameters
+        ----------
+        outfile : string
+            Path to pickle file.
+
+        """
+        # Make sure the tree is built so it does not need to be rebuilt on load
+        self.kdtree
+        with open(outfile, 'wb') as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, infile):
+        """Load a spatial index from a pickle file.
+
+        Parameters
+        ----------
+        infile : string
+            Path to pickle file.
+
+        Returns
+        -------
+        object
+            SpatialIndex instance
+
+        """
+        with open(infile, 'rb') as f:
+            return pickle.load(f)
+
+def _cached_spatial_index(key_arrays, build):
+    """Get a spatial index from the cache or build and cache it. Entries are
+    keyed on the identity of the arrays the index was built from and are
+    dropped when those arrays are garbage collected, so the index that is
+    built must not hold a reference to the key arrays.
+    """
+    key = tuple(id(arr) for arr in key_arrays)
+
+    cached = _spatial_index_cache.get(key)
+    if cached is not None and all(ref() is arr for ref, arr in zip(cached[0], key_arrays)):
+        return cached[1]
+
+    spatial_index = build()
+
+    refs = tuple(weakref.ref(arr, lambda ref, key = key: _spatial_index_cache.pop(key, None))
+                 for arr in key_arrays)
+    _spatial_index_cache[key] = (refs, spatial_index)
+
+    return spatial_index
+
+def get_section_index(grid_dict):
+    """Get the cached spatial index for the coordinates of a gridded section.
+
+    Parameters
+    ----------
+    grid_dict : dictionary
+        dictionary for gridded line data with easting and northing
+
+    Returns
+    -------
+    object
+        SpatialIndex instance
+
+    """
+    easting, northing = grid_dict['easting'], grid_dict['northing']
+
+    # The index is built from a stacked copy so it does not keep the
+    # section arrays alive
+    return _cached_spatial_index([easting, northing],
+                                 lambda: SpatialIndex(np.column_stack((easting, northing))))
+
 def nearest_neighbours(points, coords, points_required = 1,max_distance = 250.):
 
     """
     An implementation of nearest neaighbour for spatial data that uses kdtrees
 
     :param points: array of points to find the nearest neighbour for
-    :param coords: coordinates of points
+    :param coords: coordinates of points or a SpatialIndex instance
     :param points_required: number of points to return
     :param max_distance: maximum search radius
     :return:
     """
-    if len(np.array(points).shape) == 1:
-        points = np.array([points])
-
-    # Initialise tree instance
-    kdtree = cKDTree(data=coords)
-
-    # iterate throught the points and find the nearest neighbour
-    distances, indices = kdtree.query(points, k=points_required,
-                                      distance_upper_bound=max_distance)
-
-    # Mask out infitnite distances in indices to avoid confusion
-    mask = np.isfinite(distances)
-
-    if not np.all(mask):
-
-        distances[~mask] = np.nan
+    # Pass a SpatialIndex to reuse its tree across calls
+    if isinstance(coords, SpatialIndex):
+        spatial_index = coords
+    else:
+        spatial_index = SpatialIndex(coords)
 
-    return distances, indices
+    return spatial_index.query(points, points_required = points_required,
+                               max_distance = max_distance)
 
 def  layer_centre_to_top(layer_centre_depth):
     """Function for getting layer top depth from layer centre depths. Assumes
@@ -138,19 +286,79 @@ def coords2distance(coordinate_array):
 
     @return distance_array: Array of shape (n) containing cumulative distances from first coord
     '''
+    coordinate_array = np.asarray(coordinate_array)
     coord_count = coordinate_array.shape[0]
     distance_array = np.zeros((coord_count,), coordinate_array.dtype)
-    cumulative_distance = 0.0
-    distance_array[0] = cumulative_distance
-    last_point = coordinate_array[0]
-
-    for coord_index in range(1, coord_count):
-        point = coordinate_array[coord_index]
-        distance = math.sqrt(math.pow(point[0] - last_point[0], 2.0) + math.pow(point[1] - last_point[1], 2.0))
-        distance = line_length((point, last_point))
-        cumulative_distance += distance
-        distance_array[coord_index] = cumulative_distance
-        last_point = point
+
+    # Distances between consecutive points are calculated in double precision
+    steps = np.diff(coordinate_array[:, :2], axis = 0).astype(np.float64)
+    segment_lengths = np.sqrt(steps[:, 0]**2 + steps[:, 1]**2)
+
+    distance_array[1:] = np.cumsum(segment_lengths)
+
+    return distance_array
+
+def line_coords2distance(coordinate_array, fiducials, line_point_indices):
+    """Calculate the cumulative along-line distance for every line of a
+    dataset in one vectorised pass over the concatenated lines. Each line is
+    ordered in the same way as sort_variables so the distances match those
+    calculated when gridding.
+
+    Parameters
+    ----------
+    coordinate_array : array
+        Array of shape (n, 2) with the coordinates of every point.
+    fiducials : array
+        Array of shape (n) with the fiducial of every point.
+    line_point_indices : iterable
+        Iterable of arrays with the point indices of each line.
+
+    Returns
+    -------
+    array
+        Array of shape (n) with the distance of each point from the start of
+        its line.
+
+    """
+    coordinate_array = np.asarray(coordinate_array)
+    fiducials = np.asarray(fiducials)
+
+    distance_array = np.zeros((coordinate_array.shape[0],), coordinate_array.dtype)
+
+    # Concatenate the lines into a single CSR ordered array of point indices
+    line_point_indices = [np.asarray(point_inds, dtype = np.int64) for point_inds in line_point_indices]
+    counts = np.array([len(point_inds) for point_inds in line_point_indices], dtype = np.int64)
+    if counts.sum() == 0:
+        return distance_array
+    point_inds = np.concatenate(line_point_indices)
+
+    # Line number, start and end offset of each concatenated point
+    line_number = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.zeros(len(counts) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum(counts)
+    starts, ends = offsets[:-1][line_number], offsets[1:][line_number]
+
+    # First sort each line on fiducial
+    point_inds = point_inds[np.lexsort((fiducials[point_inds], line_number))]
+
+    # Then from east to west if need be by reversing the line in place
+    nonempty = counts > 0
+    reverse = np.zeros(len(counts), dtype = bool)
+    reverse[nonempty] = (coordinate_array[point_inds[offsets[:-1][nonempty]], 0] >
+                         coordinate_array[point_inds[offsets[1:][nonempty] - 1], 0])
+    position = np.arange(len(point_inds))
+    point_inds = point_inds[np.where(reverse[line_number], starts + ends - 1 - position, position)]
+
+    # Distances between consecutive points are calculated in double precision
+    steps = np.zeros(len(point_inds), dtype = np.float64)
+    diffs = np.diff(coordinate_array[point_inds, :2], axis = 0).astype(np.float64)
+    steps[1:] = np.hypot(diffs[:, 0], diffs[:, 1])
+    # No step into the first point of each line
+    steps[offsets[:-1][nonempty]] = 0.
+
+    # Segmented cumulative sum
+    cumulative = np.cumsum(steps)
+    distance_array[point_inds] = cumulative - cumulative[starts]
 
     return distance_array
 
@@ -169,6 +377,65 @@ def interpolate_1d_vars(vars_1D, var_dict, resampling_method='linear'):
 
         yield varray
 
+def section_layer_indices(grid_thicknesses, max_elevation, grid_elevations):
+    """Find the layer that fills each cell of a section grid. A cell is filled
+    by the deepest layer whose top and bottom elevations bound the cell
+    elevation.
+
+    Parameters
+    ----------
+    grid_thicknesses : array
+        Layer thicknesses of shape (number of grid distances, number of layers).
+    max_elevation : array
+        Ground elevation at each grid distance.
+    grid_elevations : array
+        Strictly descending array of grid cell elevations.
+
+    Returns
+    -------
+    array
+        Integer array of shape (number of grid distances, number of grid
+        elevations) with the layer index for each cell or -1 where the cell is
+        not within a layer.
+
+    """
+    ncols, nlayers = grid_thicknesses.shape
+    nrows = grid_elevations.shape[0]
+
+    # Get the elevation of the top and bottom of each layer
+    layer_top_depth = np.zeros(shape = grid_thicknesses.shape,
+                               dtype = grid_thicknesses.dtype)
+    layer_top_depth[:, 1:] = np.cumsum(grid_thicknesses[:, :-1], axis = 1)
+
+    etop = max_elevation[:, np.newaxis] - layer_top_depth
+    ebot = etop - grid_thicknesses
+
+    # Layers without a defined bottom are never placed. Nans propagate down
+    # through the cumulative sum so these are always the bottom layers
+    invalid = np.isnan(ebot)
+    etop[invalid] = -np.inf
+    ebot[invalid] = -np.inf
+
+    # For each layer find the first grid row that is at or below the layer top
+    first_row = np.searchsorted(-grid_elevations, -etop, side = 'left')
+
+    # Use a prefix sum over these rows to count the layer tops that are
+    # at or above each grid cell
+    flat_inds = (np.arange(ncols)[:, np.newaxis] * (nrows + 1) + first_row).ravel()
+    counts = np.bincount(flat_inds, minlength = ncols * (nrows + 1))
+    layers_above = np.cumsum(counts.reshape((ncols, nrows + 1)), axis = 1)[:, :nrows]
+
+    # The deepest layer with a top above the cell is the candidate and we
+    # check that the cell is also above its bottom
+    layer_indices = layers_above - 1
+    candidate_bottom = np.take_along_axis(ebot, np.maximum(layer_indices, 0), axis = 1)
+
+    valid = (layer_indices >= 0) & (candidate_bottom <= grid_elevations[np.newaxis, :])
+
+    layer_indices[~valid] = -1
+
+    return layer_indices
+
 def interpolate_2d_vars(vars_2d, var_dict, xres, yres):
     """
     Generator to interpolate 2d variables (i.e conductivity, uncertainty)
@@ -252,6 +519,12 @@ def interpolate_2d_vars(vars_2d, var_dict, xres, yres):
 
     # Tranform back to linear space
     grid_thicknesses = 10**grid_thicknesses
+
+    # Find the layer that fills each grid cell. This is the same for every
+    # variable so we only calculate it once per line
+    layer_indices = section_layer_indices(grid_thicknesses[:, :ndepth_cells - 1],
+                                          max_elevation, grid_elevations)
+
     # Interpolate the variables
 
     # Iterate through variables and interpolate onto new grid
@@ -281,20 +554,9 @@ def interpolate_2d_vars(vars_2d, var_dict, xres, yres):
             new_var = 10**(new_var)
 
         # Now we need to place the 2d variables on the new grid
-        for i in range(grid_distances.shape[0]):
-            dtop = 0.
-            for j in range(ndepth_cells - 1):
-                # Get the thickness
-                thick = grid_thicknesses[i,j]
-                # Find the elevation top and bottom
-                etop = max_elevation[i] - dtop
-                ebot = etop - thick
-                # Get the indices for this elevation range
-                j_ind = np.where((etop >= grid_elevations) & (ebot <= grid_elevations))
-                # Populate the section
-                interpolated_var[i, j_ind] = new_var[i,j]
-                # Update the depth top
-                dtop += thick
+        mask = layer_indices >= 0
+        interpolated_var[mask] = new_var[np.nonzero(mask)[0], layer_indices[mask]]
+
         # We also want to transpose the grid so the up elevations are up
 
         interpolated_var = interpolated_var.T
@@ -302,50 +564,113 @@ def interpolate_2d_vars(vars_2d, var_dict, xres, yres):
         # Yield the generator and the dictionary with added variables
         yield interpolated_var, var_dict
 
-def interpolate_data(data_variables, var_dict, interpolated_utm,
-                     resampling_method='linear'):
+def project_to_line(utm_coordinates, distances, points):
+    """Find the along-line distance of points by projecting them onto the
+    nearest segment of a line.
+
+    Parameters
+    ----------
+    utm_coordinates : array
+        Array of shape (n, 2) with the coordinates of the line vertices.
+    distances : array
+        Array of shape (n) with the along-line distance of each vertex.
+    points : array
+        Array of shape (m, 2) with the points to project.
+
+    Returns
+    -------
+    array
+        Array of shape (m) with the along-line distance of each point
+
+    """
+    utm_coordinates = np.asarray(utm_coordinates, dtype = np.float64)
+    distances = np.asarray(distances, dtype = np.float64)
+    points = np.asarray(points, dtype = np.float64)
+
+    # Start with the nearest vertex
+    _, nearest = SpatialIndex(utm_coordinates).query(points)
+
+    best_distance = np.sum((points - utm_coordinates[nearest])**2, axis = 1)
+    projected = distances[nearest].copy()
+
+    # Now check the segments either side of the nearest vertex
+    for offset in [-1, 0]:
+        start = nearest + offset
+        valid = (start >= 0) & (start < utm_coordinates.shape[0] - 1)
+        start = np.clip(start, 0, max(utm_coordinates.shape[0] - 2, 0))
+        end = np.minimum(start + 1, utm_coordinates.shape[0] - 1)
+
+        segment = utm_coordinates[end] - utm_coordinates[start]
+        length_sq = np.sum(segment**2, axis = 1)
+        # Fraction of the way along the segment, guarding against zero length segments
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            t = np.sum((points - utm_coordinates[start]) * segment, axis = 1) / length_sq
+        t = np.clip(np.nan_to_num(t), 0., 1.)
+
+        squared_distance = np.sum((points - utm_coordinates[start] - t[:, np.newaxis] * segment)**2,
+                                  axis = 1)
+        closer = valid & (squared_distance < best_distance)
+
+        best_distance[closer] = squared_distance[closer]
+        projected[closer] = (distances[start] + t * (distances[end] - distances[start]))[closer]
+
+    return projected
+
+def interpolate_data(data_variables, var_dict, interpolated_utm = None,
+                     resampling_method='linear', interpolated_distances = None):
     """
     :param data_variables: variables from netCDF4 dataset to interpolate
     :param var_dict: dictionary with the arrays for each variable
     :param interpolated_utm: utm corrdinates onto which to interpolate the line data
     :param resampling_method:
+    :param interpolated_distances: along-line distances onto which to interpolate
+        the line data. If None these are found by projecting interpolated_utm
+        onto the line
     :return:
     """
 
     # Define coordinates
     utm_coordinates = var_dict['utm_coordinates']
 
-    # Add distance array to dictionary
-    distances = coords2distance(utm_coordinates)
+    # Use the distance array from the dictionary if it has already been calculated
+    if 'distances' in var_dict:
+        distances = var_dict['distances']
+    else:
+        distances = coords2distance(utm_coordinates)
 
     # Now we want to find the equivalent line distance of the data based on the
-    # gridded coordinates
+    # gridded coordinates. This is only done once for all variables
 
-    interpolated_distances = griddata(utm_coordinates, distances, interpolated_utm,
-                                      method=resampling_method)
+    if interpolated_distances is None:
+        interpolated_distances = project_to_line(utm_coordinates, distances, interpolated_utm)
 
-    # Now extract the data variable, interpolate them and add them to the dictionary
+    # Stack the columns of all of the variables so they are interpolated in a
+    # single call. The data are interpolated in log10 space
 
-    for var in data_variables:
+    columns = [np.log10(var_dict[var]) for var in data_variables]
 
-        # Create an empty array for interpolation
+    if len(columns) == 0:
+        return
 
-        arr = var_dict[var]
-        print(arr.shape)
+    # Match the extrapolation of scipy.interpolate.griddata in 1D
+    fill_value = 'extrapolate' if resampling_method == 'nearest' else np.nan
 
-        interp_arr = np.zeros(shape=(np.shape(interpolated_distances)[0], np.shape(arr)[1]),
-                              dtype=var_dict[var].dtype)
+    f = interp1d(distances, np.column_stack(columns), kind = resampling_method,
+                 axis = 0, bounds_error = False, fill_value = fill_value)
 
-        # Interpolate each column separately
+    interpolated = 10**f(interpolated_distances)
 
-        for j in range(interp_arr.shape[1]):
+    # Now split the interpolated array into the variables
 
-            vals = np.log10(arr[:, j])
+    start = 0
 
-            interp_arr[:, j] = 10**griddata(distances, vals, interpolated_distances,
-                                            method=resampling_method)
+    for var, column in zip(data_variables, columns):
 
-        # Add to the dictionary
+        stop = start + column.shape[1]
+
+        interp_arr = interpolated[:, start:stop].astype(var_dict[var].dtype)
+
+        start = stop
 
         yield interp_arr
 
@@ -359,10 +684,7 @@ def xy_2_var(grid_dict, xy, var):
     returns
     float: distance along line
     """
-    utm_coords = np.column_stack((grid_dict['easting'],
-                                  grid_dict['northing']))
-
-    d, i = nearest_neighbours(xy, utm_coords, max_distance=100.)
+    d, i = nearest_neighbours(xy, get_section_index(grid_dict), max_distance=100.)
     if np.isnan(d[0]):
         return None
 
@@ -370,9 +692,57 @@ def xy_2_var(grid_dict, xy, var):
         near_ind = i[0]
         return grid_dict[var][near_ind]
 
+def _points_in_ring(coords, ring):
+    # Crossing number test, vectorised over the points
+    ring = np.asarray(ring, dtype = np.float64)
+    x, y = coords[:,0], coords[:,1]
+    inside = np.zeros(coords.shape[0], dtype = bool)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+            crosses = (y1 > y) != (y2 > y)
+            inside ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+    return inside
+
+def polygon_mask(coords, polygon):
+    """Vectorised test of which coordinates fall within a polygon.
+
+    Parameters
+    ----------
+    coords : array
+        Array of shape (n, 2) with the coordinates to test.
+    polygon : shapely geometry
+        Polygon or multipolygon. Points within holes are outside.
+
+    Returns
+    -------
+    array
+        Boolean array of shape (n) that is True where the coordinate is within
+        the polygon
+
+    """
+    coords = np.asarray(coords, dtype = np.float64).reshape((-1, 2))
+
+    mask = np.zeros(coords.shape[0], dtype = bool)
+
+    polygons = getattr(polygon, 'geoms', [polygon])
+
+    for poly in polygons:
+        # Only test points within the bounding box of this polygon
+        xmin, ymin, xmax, ymax = poly.bounds
+        candidates = np.where((coords[:,0] >= xmin) & (coords[:,0] <= xmax) &
+                              (coords[:,1] >= ymin) & (coords[:,1] <= ymax))[0]
+        if len(candidates) == 0:
+            continue
+        inside = _points_in_ring(coords[candidates], poly.exterior.coords)
+        for interior in poly.interiors:
+            inside &= ~_points_in_ring(coords[candidates], interior.coords)
+        mask[candidates[inside]] = True
+
+    return mask
+
 def return_valid_points(points, coords, extent):
     # Now get points that are within our survey area
-    mask = [Point(coords[id]).within(extent) for id in points]
+    mask = polygon_mask(coords[points], extent)
     u, indices = np.unique(np.array(points)[mask], return_index = True)
 
     return u[indices]
@@ -402,11 +772,9 @@ def interp2scatter(surface, line, gridded_data, easting_col = 'X',
 
     """
     mask = surface.interpreted_points[line_col] == line
-    utm_coords = np.column_stack((gridded_data[line]['easting'],
-                                  gridded_data[line]['northing']))
 
     dist, inds = nearest_neighbours(surface.interpreted_points[mask][[easting_col,northing_col]].values,
-                                                      utm_coords, max_distance=100.)
+                                    get_section_index(gridded_data[line]), max_distance=100.)
 
     grid_dists = gridded_data[line]['grid_distances'][inds]
     elevs = surface.interpreted_points[mask][elevation_col].values